@@ -1,5 +1,6 @@
 import argparse
 import json
+import multiprocessing
 from getpass import getpass
 from os.path import basename, dirname, exists, isabs, join
 import os
@@ -11,6 +12,8 @@ import numpy as np
 import yaml
 
 from iris.extensions import db, compress
+from iris.jobs import jobs
+from iris.prefetch import prefetcher
 from iris.project import project
 
 def get_demo_file(example=None):
@@ -25,7 +28,9 @@ def parse_cmd_line():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "mode", type=str,
-        help="Specify the mode you want to start iris, can be either *label* or *demo*."
+        help="Specify the mode you want to start iris, can be either *label*, "
+            "*demo*, *bake* (pre-render all views of all images) or *ingest* "
+            "(convert all image files to memory-mapped bands)."
     )
     parser.add_argument(
         "project", type=str, nargs='?',
@@ -38,19 +43,32 @@ def parse_cmd_line():
     parser.add_argument(
         "-p","--production", action="store_true",
         help="Use production WSGI server")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="Number of processes for *bake* and *ingest* (default: number "
+            "of CPUs)")
     args = parser.parse_args()
 
     if args.mode == "demo":
         args.project = get_demo_file()
-    elif args.mode == "label":
+    elif args.mode in ["label", "bake", "ingest"]:
         if not args.project:
-            raise Exception("Label mode require a project file!")
+            raise Exception(f"{args.mode.capitalize()} mode require a project file!")
     else:
         raise Exception(f"Unknown mode '{args.mode}'!")
 
     return vars(args)
 
 def run_app():
+    if args.get('mode') == 'bake':
+        from iris.bake import bake
+        bake(args['project'], jobs=args['jobs'])
+        return
+    if args.get('mode') == 'ingest':
+        from iris.ingest import ingest
+        ingest(args['project'], jobs=args['jobs'])
+        return
+
     create_default_admin(app)
     if args['production']:
         import gevent.pywsgi
@@ -75,6 +93,8 @@ def create_app(project_file, args):
     # Register the extensions:
     db.init_app(app)
     compress.init_app(app)
+    prefetcher.init(project['prefetch'])
+    jobs.init(project['jobs'])
 
     return app
 
@@ -120,22 +140,27 @@ def register_extensions(app):
     from iris.user import user_app
     app.register_blueprint(user_app, url_prefix="/user")
 
-if len(sys.argv) > 1:
-    args = parse_cmd_line()
-else:
-    args = {
-        'debug': False
-    }
-    args['project'] = get_demo_file()
+# Worker processes (of the jobs, bake and ingest) are spawned and import this
+# package anew (before multiprocessing.parent_process is set, but after their
+# name is). They load the project themselves (e.g. see iris.worker) and must
+# not create another app with its background threads:
+if multiprocessing.current_process().name == 'MainProcess':
+    if len(sys.argv) > 1:
+        args = parse_cmd_line()
+    else:
+        args = {
+            'debug': False
+        }
+        args['project'] = get_demo_file()
 
-app = create_app(args['project'], args)
-from iris.models import User, Action
+    app = create_app(args['project'], args)
+    from iris.models import User, Action
 
-with app.app_context():
-    db.create_all()
-    db.session.commit()
+    with app.app_context():
+        db.create_all()
+        db.session.commit()
 
-register_extensions(app)
+    register_extensions(app)
 
 
 if __name__ == '__main__':
@@ -7,6 +7,8 @@ from sqlalchemy import func
 
 from iris.user import requires_admin, requires_auth
 from iris.models import db, Action, User
+from iris.jobs import jobs
+from iris.prefetch import prefetcher
 from iris.project import project
 
 admin_app = flask.Blueprint(
@@ -119,3 +121,21 @@ def images():
         'admin/images.html', images=images, order_by=order_by, ascending=ascending
     )
     return flask.render_template('admin/index.html', user=user, page=markupsafe.Markup(html))
+
+@admin_app.route('/stats', methods=['GET'])
+@requires_admin
+def stats():
+    return flask.jsonify({
+        'band_cache': project.band_cache.stats(),
+        'datasets': project.datasets.stats(),
+        'view_cache': project.view_cache.stats(),
+        'baked': project.baked.stats(),
+        'band_stats': project.band_stats.stats() if project.band_stats else None,
+        'manifest': project.manifest.stats(),
+        'metadata_index': project.metadata_index.stats(),
+        'features': project.features.stats(),
+        'model_sessions': project.model_sessions.stats(),
+        'prefetch': prefetcher.stats(),
+        'jobs': jobs.stats(),
+        'render': project.render_stats,
+    })
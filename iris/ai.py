@@ -0,0 +1,404 @@
+"""Train the AI model of the segmentation and predict masks with it
+
+The predictions run as jobs in worker processes (see `iris.jobs`). Unlike the
+segmentation blueprint, this module does not depend on flask, so the workers
+can import it without anything of the web app.
+
+"""
+import json
+
+import lightgbm as lgb
+import numpy as np
+from scipy.ndimage import convolve
+from skimage.filters import sobel
+from skimage.segmentation import felzenszwalb
+
+from iris.cache import hash_key
+from iris.project import project
+
+def image_dict_to_array(image_dict):
+    if isinstance(image_dict, np.ndarray):
+        return image_dict
+
+    return np.dstack(
+        [image_dict_to_array(v) for v in image_dict.values()]
+    )
+
+def get_features(image_id, config):
+    """Get the features of the AI model for the masking area of an image
+
+    The features do not depend on the labelled pixels, so they are cached in
+    the feature store of the project.
+
+    Args:
+        image_id: Id of the image.
+        config: Segmentation config of the user.
+
+    Returns:
+        Read-only float32 array with one row per pixel of the masking area and
+        one column per feature.
+    """
+    ai_config = config['ai_model']
+    key = (
+        ai_config['bands'] and tuple(ai_config['bands']),
+        tuple(config['mask_area']),
+        ai_config['use_edge_filter'],
+        ai_config['use_superpixels'],
+        ai_config['use_meshgrid'] and ai_config['meshgrid_cells'],
+    )
+    return project.features.get(
+        image_id, key, max(project.get_image_mtimes(image_id)),
+        lambda: compute_features(image_id, config)
+    )
+
+def compute_features(image_id, config):
+    """Compute the features of the AI model (see `get_features`)"""
+    # Read only the masking area. The edge filter needs one more pixel on each
+    # side to be correct at the border of the area:
+    halo = 1 if config['ai_model']['use_edge_filter'] else 0
+    image_dict = project.get_image(
+        image_id, bands=config['ai_model']['bands'],
+        window=config['mask_area'], halo=halo
+    )
+    image = image_dict_to_array(image_dict)
+    _, mask_area = project.expand_window(config['mask_area'], halo)
+
+    n_channels = image.shape[-1]
+
+    mask_size = config['mask_shape'][0] * config['mask_shape'][1]
+    image_with_halo = image
+    image = image[mask_area]
+
+    inputs = [image]
+    if config['ai_model']['use_edge_filter']:
+        edges = np.dstack([
+            sobel(image_with_halo[..., i])[mask_area]
+            for i in range(n_channels)
+        ])
+        inputs.append(edges)
+
+    if config['ai_model']['use_meshgrid']:
+        if config['ai_model']['meshgrid_cells'] == "pixelwise":
+            x_size, y_size = image.shape[0], image.shape[1]
+        else:
+            x_size, y_size = map(int, config['ai_model']['meshgrid_cells'].split('x'))
+        y_size = 3
+        x = np.repeat(np.arange(x_size), int(image.shape[0]/x_size)+1)
+        y = np.repeat(np.arange(y_size), int(image.shape[1]/y_size)+1)
+        x_grid, y_grid = np.meshgrid(x[:image.shape[0]], y[:image.shape[1]])
+        inputs.append(x_grid[..., np.newaxis])
+        inputs.append(y_grid[..., np.newaxis])
+
+    if config['ai_model']['use_superpixels']:
+        super_pixels = felzenszwalb(
+            image, scale=image.shape[0]/5, sigma=4, min_size=100
+        )
+        inputs.append(super_pixels)
+
+    # Fill one float32 matrix instead of stacking everything with float64:
+    inputs = [
+        array[..., np.newaxis] if array.ndim == 2 else array
+        for array in inputs
+    ]
+    features = np.empty(
+        (*image.shape[:2], sum(array.shape[-1] for array in inputs)),
+        dtype=np.float32
+    )
+    column = 0
+    for array in inputs:
+        features[..., column:column+array.shape[-1]] = array
+        column += array.shape[-1]
+    return features.reshape(mask_size, -1)
+
+class ModelSession:
+    """Model of a user for an image, kept between predictions
+
+    Args:
+        booster: The trained LightGBM booster.
+        classes: Sorted array of the classes the booster was trained on.
+        key: Key of the model options and the image (see `get_model_key`).
+        indices: Sorted array of the pixel indices the booster was trained on.
+        labels: Labels of these pixels.
+    """
+    def __init__(self, booster, classes, key, indices, labels):
+        self.booster = booster
+        self.classes = classes
+        self.key = key
+        self.indices = indices
+        self.labels = labels
+
+    def predict(self, inputs, threads=None):
+        """Predict the classes of all pixels"""
+        probabilities = self.booster.predict(inputs, num_threads=threads or 0)
+        if probabilities.ndim == 1:
+            # Binary classification, probabilities of the second class:
+            return self.classes[(probabilities > 0.5).astype(int)]
+        return self.classes[np.argmax(probabilities, axis=1)]
+
+    def find_new_pixels(self, indices, labels):
+        """Find the pixels this model has not been trained on yet
+
+        Returns:
+            Boolean array which is True for new pixels or None if pixels the
+            model was trained on have changed their label.
+        """
+        positions = np.searchsorted(self.indices, indices)
+        positions = np.minimum(positions, len(self.indices) - 1)
+        known = self.indices[positions] == indices
+        if np.any(self.labels[positions[known]] != labels[known]):
+            return None
+        return ~known
+
+def get_model_key(image_id, config):
+    """Key of everything except for the labelled pixels a model depends on"""
+    ai_config = {
+        name: value for name, value in config['ai_model'].items()
+        if name not in ['warm_start', 'warm_start_rounds', 'max_boosting_rounds']
+    }
+    return hash_key((
+        json.dumps(ai_config, sort_keys=True), tuple(config['mask_area']),
+        project.get_image_mtimes(image_id)
+    ))
+
+def train_model(
+        image_id, user_id, config, inputs, user_indices, user_labels,
+        threads=None):
+    """Train a model on the labelled pixels
+
+    The model of the last prediction of the user for this image is kept in a
+    session. If the user only labelled further pixels (of the same classes),
+    boosting continues from this model on the new pixels instead of training
+    a new model from scratch.
+
+    Args:
+        threads: Number of threads LightGBM may use. Defaults to all cores.
+
+    Returns:
+        The updated `ModelSession`.
+    """
+    ai_config = config['ai_model']
+    key = get_model_key(image_id, config)
+    # Sessions keep the pixels sorted by their index:
+    order = np.argsort(user_indices, kind='stable')
+    indices, labels = user_indices[order], user_labels[order]
+
+    rng = np.random.RandomState(42)
+    weights = get_pixel_weights(
+        user_indices, user_labels, config['mask_shape'],
+        ai_config['boundary_weight']
+    )
+
+    session = None
+    if ai_config['warm_start']:
+        session = project.model_sessions.get((user_id, image_id))
+    if session is not None and session.key == key \
+            and np.array_equal(session.classes, np.unique(labels)) \
+            and session.booster.current_iteration() \
+                + ai_config['warm_start_rounds'] \
+                <= ai_config['max_boosting_rounds']:
+        new = session.find_new_pixels(indices, labels)
+        if new is not None:
+            if np.any(new):
+                train, _ = sample_pixels(
+                    labels[new], weights[order][new], 1,
+                    ai_config['max_train_pixels'], rng
+                )
+                session = continue_training(
+                    session, config, inputs, indices[new][train],
+                    labels[new][train], threads
+                )
+            session.indices, session.labels = merge_pixels(
+                session.indices, session.labels, indices[new], labels[new]
+            )
+            project.model_sessions.put((user_id, image_id), session)
+            return session
+
+    train, val = sample_pixels(
+        user_labels, weights, ai_config['train_ratio'],
+        ai_config['max_train_pixels'], rng
+    )
+    train_indices, train_labels = user_indices[train], user_labels[train]
+    val_indices, val_labels = user_indices[val], user_labels[val]
+
+    gbm = lgb.LGBMClassifier(
+        num_leaves=ai_config['n_leaves'],
+        max_bin=128,
+        max_depth=ai_config['max_depth'],
+        # min_data_in_leaf=1000,
+        # bagging_fraction=0.2,
+        # boosting_type='dart',
+        tree_learner='data',
+        learning_rate=0.05,
+        n_estimators=ai_config['n_estimators'],
+        n_jobs=threads,
+    )
+    if len(val_indices):
+        early_stopping = lgb.early_stopping(4, verbose=False)
+        gbm.fit(
+            inputs[train_indices, :], train_labels,
+            eval_set=[(inputs[val_indices, :], val_labels)],
+            callbacks=[early_stopping]
+        )
+    else:
+        # All pixels are used for training (train_ratio is 1):
+        gbm.fit(inputs[train_indices, :], train_labels)
+
+    # Keep only the trees up to the best iteration, so that further boosting
+    # continues from there:
+    booster = lgb.Booster(model_str=gbm.booster_.model_to_string(
+        num_iteration=gbm.best_iteration_
+    ))
+    session = ModelSession(booster, gbm.classes_, key, indices, labels)
+    if ai_config['warm_start']:
+        project.model_sessions.put((user_id, image_id), session)
+    return session
+
+def continue_training(session, config, inputs, indices, labels, threads=None):
+    """Continue boosting the model of a session on new pixels"""
+    ai_config = config['ai_model']
+    n_classes = len(session.classes)
+    params = {
+        'objective': 'binary' if n_classes == 2 else 'multiclass',
+        'num_leaves': ai_config['n_leaves'],
+        'max_bin': 128,
+        'max_depth': ai_config['max_depth'],
+        'tree_learner': 'data',
+        'learning_rate': 0.05,
+        'num_threads': threads or 0,
+        'verbose': -1,
+    }
+    if n_classes > 2:
+        params['num_class'] = n_classes
+
+    session.booster = lgb.train(
+        params,
+        lgb.Dataset(
+            inputs[indices, :], np.searchsorted(session.classes, labels)
+        ),
+        num_boost_round=ai_config['warm_start_rounds'],
+        init_model=session.booster,
+    )
+    return session
+
+def get_pixel_weights(indices, labels, mask_shape, boundary_weight):
+    """Get the sampling weights of the labelled pixels
+
+    Pixels at the boundary between two classes (i.e. with a 4-neighbour
+    labelled as another class) are the hardest ones for the model, so they
+    can be sampled more likely than pixels inside a brush stroke.
+
+    Args:
+        indices: Indices of the labelled pixels in the flattened mask.
+        labels: Labels of these pixels.
+        mask_shape: Shape of the mask (height, width).
+        boundary_weight: Weight of boundary pixels relative to the others.
+
+    Returns:
+        Array with the weight of each pixel.
+    """
+    weights = np.ones(len(indices))
+    if boundary_weight == 1 or not len(indices):
+        return weights
+
+    mask = np.full(mask_shape, -1, dtype=int)
+    mask.flat[indices] = labels
+    padded = np.pad(mask, 1, constant_values=-1)
+    boundary = np.zeros(mask_shape, dtype=bool)
+    for neighbour in [
+            padded[:-2, 1:-1], padded[2:, 1:-1],
+            padded[1:-1, :-2], padded[1:-1, 2:]]:
+        boundary |= (neighbour != -1) & (neighbour != mask)
+    weights[boundary.flat[indices]] = boundary_weight
+    return weights
+
+def sample_pixels(labels, weights, train_ratio, max_train_pixels, rng):
+    """Split the labelled pixels into training and validation pixels
+
+    Each class is sampled on its own (stratified), so that large brush
+    strokes of one class do not crowd out the others. Of each class,
+    `train_ratio` of its pixels but at most `max_train_pixels` are sampled for
+    training. The validation pixels are sampled in the same ratio to the
+    training pixels from the rest. The samples are drawn by weighted
+    reservoir sampling (A-Res), i.e. each pixel gets the random key
+    u^(1/weight) and the pixels with the largest keys are taken.
+
+    Args:
+        labels: Labels of the pixels.
+        weights: Sampling weights of the pixels (see `get_pixel_weights`).
+        train_ratio: Ratio of the pixels of a class used for training.
+        max_train_pixels: Maximum number of training pixels per class.
+        rng: `numpy.random.RandomState` to draw the keys.
+
+    Returns:
+        Positions of the training and of the validation pixels.
+    """
+    train = []
+    val = []
+    for label in np.unique(labels):
+        positions = np.flatnonzero(labels == label)
+        n_train = int(min(
+            max(round(len(positions) * train_ratio), 1), max_train_pixels,
+            len(positions)
+        ))
+        if train_ratio > 0:
+            n_val = int(min(
+                np.ceil(n_train * (1 - train_ratio) / train_ratio),
+                len(positions) - n_train
+            ))
+        else:
+            # A user config might still contain a ratio of 0:
+            n_val = len(positions) - n_train
+        keys = rng.random_sample(len(positions)) ** (1 / weights[positions])
+        ranked = positions[np.argsort(-keys, kind='stable')]
+        train.append(ranked[:n_train])
+        val.append(ranked[n_train:n_train+n_val])
+    return np.concatenate(train), np.concatenate(val)
+
+def merge_pixels(indices, labels, new_indices, new_labels):
+    """Merge two sets of labelled pixels (sorted by their indices)"""
+    indices = np.concatenate([indices, new_indices])
+    labels = np.concatenate([labels, new_labels])
+    order = np.argsort(indices, kind='stable')
+    return indices[order], labels[order]
+
+def predict(image_id, user_id, user_pixels, user_labels, threads=None):
+    """Train the AI model on the labelled pixels and predict the mask
+
+    Runs in a worker process (see `iris.jobs`) with the number of threads the
+    job was granted.
+
+    Returns:
+        The predicted classes of all pixels of the mask as bytes (uint8).
+    """
+    config = project.get_user_config(user_id)
+    config = config['segmentation']
+
+    print('Fit options:', config)
+
+    user_indices = np.array(user_pixels)
+    user_labels = np.array(user_labels)
+
+    inputs = get_features(image_id, config)
+
+    model = train_model(
+        image_id, user_id, config, inputs, user_indices, user_labels, threads
+    )
+
+    # predict the mask for the whole image:
+    predictions = model.predict(inputs, threads)
+    predictions = predictions.astype(np.uint8)
+
+    # Apply suppression filter:
+    if config['ai_model']['suppression_threshold'] != 0:
+        other_classes = (predictions != config['ai_model']['suppression_default_class']).astype(int)
+        other_classes = other_classes.reshape(*config['mask_shape'])
+        window_size = config['ai_model']['suppression_filter_size']
+        window = np.ones((window_size, window_size))
+        window[window_size//2, window_size//2] = 0
+        neighbourhood_ratio = convolve(
+            other_classes, window, mode='constant', cval=0.5
+        ) / (window_size**2 - 1)
+        suppress = 100 * neighbourhood_ratio.ravel() < config['ai_model']['suppression_threshold']
+        predictions[suppress] = config['ai_model']['suppression_default_class']
+
+    return predictions.tobytes()
@@ -0,0 +1,118 @@
+"""Pre-render all views of all images (`iris bake`)
+
+Rendering views is expensive. With `iris bake`, all views and thumbnails of
+all images are rendered once in parallel and stored in the project directory.
+The image and thumbnail routes serve these files as long as they are fresh,
+i.e. as long as neither the view definitions nor the image files changed.
+
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import time
+
+from iris.project import project
+
+
+def bake(project_file, jobs=None):
+    """Render all views and thumbnails of all images of a project
+
+    Args:
+        project_file: Path to the project file.
+        jobs: Number of worker processes. Defaults to the number of CPUs.
+    """
+    if project.file is None:
+        project.load_from(project_file)
+
+    jobs = jobs or os.cpu_count()
+    image_ids = list(project.image_ids)
+    print(
+        f'Baking {len(image_ids)} images of {project["name"]} with {jobs} '
+        'processes...'
+    )
+
+    start = time.time()
+    rendered = 0
+    skipped = 0
+    with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=(project.file,),
+            # The server threads (e.g. the manifest rescans) are running
+            # already, forking could deadlock (see iris.jobs):
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {
+            executor.submit(bake_image, image_id): image_id
+            for image_id in image_ids
+        }
+        for i, future in enumerate(as_completed(futures)):
+            image_id = futures[future]
+            try:
+                image_rendered, image_skipped = future.result()
+            except Exception as error:
+                print(f'[ERROR] Could not bake {image_id}: {error}')
+                continue
+            rendered += image_rendered
+            skipped += image_skipped
+            print(f'[{i+1}/{len(image_ids)}] Baked {image_id}')
+
+    print(
+        f'Rendered {rendered} files, {skipped} were already fresh '
+        f'({time.time()-start:.1f}s).'
+    )
+
+
+def _init_worker(project_file):
+    # The spawned processes need to load the project (without rescanning the
+    # manifest, which the main process does already):
+    if project.file is None:
+        project.load_from(project_file, rescan=False)
+
+
+def bake_image(image_id):
+    """Render all views and the thumbnail of one image
+
+    Returns:
+        Number of rendered and skipped (still fresh) files.
+    """
+    # Avoid circular imports since iris.main needs the loaded app:
+    from iris.main import encode_image, get_default_encoding, get_encoding_key
+
+    encoding = get_default_encoding()
+
+    rendered = 0
+    skipped = 0
+    keep = set()
+
+    for name, view in project['views'].items():
+        if 'data' not in view:
+            continue
+        key = (
+            *project.get_view_key(image_id, view), get_encoding_key(encoding)
+        )
+        if project.baked.has(image_id, name, key):
+            skipped += 1
+        else:
+            project.baked.put(
+                image_id, name, key,
+                encode_image(project.render_image(image_id, view), encoding)
+            )
+            rendered += 1
+        keep.add(project.baked.path(image_id, name, key))
+
+    key = project.get_thumbnail_key(image_id)
+    if key is not None:
+        key = (*key, get_encoding_key(encoding))
+        if project.baked.has(image_id, 'thumbnail', key):
+            skipped += 1
+        else:
+            project.baked.put(
+                image_id, 'thumbnail', key,
+                encode_image(project.get_thumbnail(image_id), encoding)
+            )
+            rendered += 1
+        keep.add(project.baked.path(image_id, 'thumbnail', key))
+
+    # Delete renderings of outdated views and files:
+    project.baked.clean(image_id, keep)
+
+    return rendered, skipped
@@ -0,0 +1,68 @@
+"""Lazy access to the bands of image files
+
+"""
+from collections.abc import Mapping
+import threading
+
+
+class LazyBands(Mapping):
+    """Bands of an image file which are read only when they are accessed
+
+    Behaves like a read-only dictionary with the band names (e.g. "B1") as keys
+    and 2D arrays as values. Iterating over the keys or checking whether a band
+    exists does not read anything.
+
+    Args:
+        names: List of band names.
+        indices: List of band indices (zero-based) in the file, one per name.
+        read: Function which reads bands from the file. Gets a list of band
+            indices and returns a list of 2D arrays.
+        batch: If True, all bands are read at once when the first one is
+            accessed. Use this if all bands are needed anyway (e.g. because
+            they were selected explicitly), so that pixel-interleaved files
+            are decoded only once.
+        dtype: If given, the bands are converted to this data type.
+    """
+    def __init__(self, names, indices, read, batch=False, dtype=None):
+        self.names = list(names)
+        self.indices = dict(zip(self.names, indices))
+        self.read = read
+        self.batch = batch
+        self.dtype = dtype
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        if name not in self.indices:
+            raise KeyError(name)
+
+        with self.lock:
+            if name not in self.loaded:
+                self._read(self.names if self.batch else [name])
+            return self.loaded[name]
+
+    def load(self):
+        """Read all bands which have not been read yet"""
+        with self.lock:
+            self._read(self.names)
+        return self
+
+    def _read(self, names):
+        names = [name for name in names if name not in self.loaded]
+        if not names:
+            return
+
+        arrays = self.read([self.indices[name] for name in names])
+        for name, array in zip(names, arrays):
+            if self.dtype is not None:
+                array = array.astype(self.dtype, copy=False)
+            self.loaded[name] = array
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.indices
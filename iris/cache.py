@@ -0,0 +1,940 @@
+"""Caches used to avoid redoing expensive work between requests
+
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+from hashlib import sha1
+import json
+from math import ceil
+import os
+from os.path import exists, getmtime, join
+import threading
+import time
+
+import numpy as np
+import rasterio as rio
+
+
+def hash_key(key):
+    """Create a stable hash string from a (nested) tuple of simple values"""
+    return sha1(repr(key).encode('utf-8')).hexdigest()
+
+def to_json_value(value):
+    """Convert parsed metadata (e.g. from YAML) to plain JSON values
+
+    Dates and datetimes become ISO strings, keys become strings and other
+    unknown types their string representation. This is what the metadata would
+    look like after a round trip through a JSON file.
+    """
+    if isinstance(value, dict):
+        return {str(key): to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(item) for item in value]
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with a byte budget
+
+    Args:
+        max_bytes: Maximum number of bytes held by the cache. If 0, nothing is
+            cached at all.
+        sizeof: Function which returns the size in bytes of a cached value.
+            Defaults to `len` which works for byte strings.
+    """
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = int(max_bytes)
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            # Would evict everything else and still not fit:
+            return
+
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+            self.items[key] = (value, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self.items.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class RenderCache:
+    """Cache for encoded renderings with a memory and an optional disk tier
+
+    The memory tier is an LRU cache with a byte budget. The disk tier (if a
+    directory is given) keeps every rendering as a file named after the hash of
+    its key, so it survives restarts of IRIS. Since the keys contain the view
+    definition and the modification times of the source files, outdated files
+    are simply never requested again and eventually evicted when the disk tier
+    exceeds its budget (oldest files first).
+
+    Args:
+        max_bytes: Byte budget of the memory tier.
+        directory: Directory for the disk tier. If None, no disk tier is used.
+        max_disk_bytes: Byte budget of the disk tier.
+    """
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=2**30):
+        self.memory = LRUCache(max_bytes)
+        self.directory = directory
+        self.max_disk_bytes = int(max_disk_bytes)
+        self.disk_bytes = 0
+        self.disk_hits = 0
+        self.disk_writes = 0
+        self.disk_evictions = 0
+        self.disk_lock = threading.Lock()
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.disk_bytes = sum(size for _, _, size in self._disk_files())
+
+    def _disk_files(self):
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                filename = join(root, file)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                yield filename, stat.st_mtime, stat.st_size
+
+    def _evict_disk(self):
+        """Delete the oldest files until the disk tier is within budget again"""
+        files = sorted(self._disk_files(), key=lambda f: f[1])
+        self.disk_bytes = sum(size for _, _, size in files)
+        # Make some room so that we do not have to scan the directory after
+        # each new write:
+        target = 0.9 * self.max_disk_bytes
+        for filename, _, size in files:
+            if self.disk_bytes <= target:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+            self.disk_evictions += 1
+
+    def _filename(self, key):
+        hashed = hash_key(key)
+        return join(self.directory, hashed[:2], hashed)
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is not None or self.directory is None:
+            return data
+
+        filename = self._filename(key)
+        if not exists(filename):
+            return None
+
+        try:
+            with open(filename, 'rb') as stream:
+                data = stream.read()
+        except OSError:
+            return None
+
+        self.disk_hits += 1
+        self.memory.put(key, data)
+        return data
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+
+        if self.directory is None:
+            return
+
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Write to a temporary file first so that concurrent readers never see
+        # half-written files:
+        temp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+        with open(temp_filename, 'wb') as stream:
+            stream.write(data)
+        os.replace(temp_filename, filename)
+
+        with self.disk_lock:
+            self.disk_writes += 1
+            self.disk_bytes += len(data)
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self):
+        return {
+            **self.memory.stats(),
+            'disk': self.directory is not None,
+            'disk_bytes': self.disk_bytes,
+            'max_disk_bytes': self.max_disk_bytes,
+            'disk_hits': self.disk_hits,
+            'disk_writes': self.disk_writes,
+            'disk_evictions': self.disk_evictions,
+        }
+
+
+class BakedStore:
+    """On-disk store for renderings created offline with `iris bake`
+
+    Each rendering is stored in a file named after the hash of its name and
+    its key (which contains the view definition and the modification times of
+    the source files). A rendering is fresh if a file for its current key
+    exists. The directory contains the version of the store format, so
+    changing the format never serves outdated files.
+
+    Args:
+        directory: Directory of the store.
+    """
+    VERSION = 2
+
+    def __init__(self, directory):
+        self.directory = join(directory, f'v{self.VERSION}')
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, image_id, name, key):
+        """Path of the file which holds a rendering"""
+        return join(self.directory, image_id, hash_key((name, key)))
+
+    def get(self, image_id, name, key):
+        filename = self.path(image_id, name, key)
+        try:
+            with open(filename, 'rb') as stream:
+                data = stream.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    def has(self, image_id, name, key):
+        return exists(self.path(image_id, name, key))
+
+    def put(self, image_id, name, key, data):
+        filename = self.path(image_id, name, key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+        with open(temp_filename, 'wb') as stream:
+            stream.write(data)
+        os.replace(temp_filename, filename)
+        return filename
+
+    def clean(self, image_id, keep):
+        """Delete all renderings of an image except the given files"""
+        directory = join(self.directory, image_id)
+        if not exists(directory):
+            return
+        for file in os.listdir(directory):
+            filename = join(directory, file)
+            # Skip temporary files of concurrent writers:
+            if filename not in keep and '.' not in file:
+                os.remove(filename)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class DatasetPool:
+    """Thread-safe pool of open rasterio datasets
+
+    Opening a dataset can be more expensive than reading from it (e.g. a VRT
+    has to parse its XML and open all of its sources). Datasets are therefore
+    kept open after use and handed out again for the same path. Since a
+    dataset must not be used by two threads at the same time, each one is
+    lent to one user only; concurrent users of the same path get their own
+    dataset. Datasets of modified files are not reused.
+
+    Args:
+        max_open: Maximum number of idle datasets which are kept open. If 0,
+            datasets are closed directly after use.
+        idle_timeout: Idle datasets are closed after this number of seconds.
+    """
+    def __init__(self, max_open=64, idle_timeout=300):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        # Idle datasets as tuples of (path, mtime, dataset, released at), the
+        # least recently used first:
+        self.idle = []
+        self.opened = 0
+        self.reused = 0
+        self.closed = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def open(self, path):
+        """Borrow an open dataset for a path (use as context manager)"""
+        mtime = getmtime(path)
+        dataset = self._acquire(path, mtime)
+        try:
+            yield dataset
+        finally:
+            self._release(path, mtime, dataset)
+
+    def _acquire(self, path, mtime):
+        with self.lock:
+            self._close_expired()
+            for i in reversed(range(len(self.idle))):
+                idle_path, idle_mtime, dataset, _ = self.idle[i]
+                if idle_path != path:
+                    continue
+                del self.idle[i]
+                if idle_mtime == mtime:
+                    self.reused += 1
+                    return dataset
+                # The file has been modified in the meantime:
+                self._close(dataset)
+
+        dataset = rio.open(path)
+        with self.lock:
+            self.opened += 1
+        return dataset
+
+    def _release(self, path, mtime, dataset):
+        with self.lock:
+            self.idle.append((path, mtime, dataset, time.time()))
+            while len(self.idle) > self.max_open:
+                self._close(self.idle.pop(0)[2])
+
+    def _close_expired(self):
+        deadline = time.time() - self.idle_timeout
+        while self.idle and self.idle[0][3] < deadline:
+            self._close(self.idle.pop(0)[2])
+
+    def _close(self, dataset):
+        dataset.close()
+        self.closed += 1
+
+    def clear(self):
+        with self.lock:
+            while self.idle:
+                self._close(self.idle.pop()[2])
+
+    def stats(self):
+        return {
+            'idle': len(self.idle),
+            'max_open': self.max_open,
+            'opened': self.opened,
+            'reused': self.reused,
+            'closed': self.closed,
+        }
+
+
+class BandStatsStore:
+    """Statistics of the bands of views, persisted in the project directory
+
+    For each image and band expression, the minimum, maximum, a histogram and
+    all percentiles requested so far are stored. The percentiles of large
+    bands are approximated from the histogram instead of sorting all pixels.
+    Statistics are filled lazily whenever a band is stretched (and therefore
+    also by `iris bake`). They are stored in one JSON file per image together
+    with the modification times of the image files, so statistics of changed
+    images are discarded. New statistics are only written when `save` is
+    called, so all bands of a view are saved at once.
+
+    Args:
+        directory: Directory of the store.
+        approximate_above: Percentiles of bands with more pixels than this are
+            approximated from the histogram.
+        max_images: Maximum number of images whose statistics are kept in
+            memory.
+    """
+    VERSION = 1
+    BINS = 1024
+
+    def __init__(self, directory, approximate_above=2**24, max_images=256):
+        self.directory = join(directory, f'v{self.VERSION}')
+        self.approximate_above = approximate_above
+        self.images = LRUCache(max_images, sizeof=lambda entry: 1)
+        # Entries with unsaved statistics (they must not be evicted):
+        self.unsaved = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _filename(self, image_id):
+        return join(self.directory, image_id + '.json')
+
+    def _load(self, image_id, mtimes):
+        mtimes = list(mtimes)
+        entry = self.unsaved.get(image_id) or self.images.get(image_id)
+        if entry is None:
+            try:
+                with open(self._filename(image_id)) as stream:
+                    entry = json.load(stream)
+            except (OSError, ValueError):
+                pass
+
+        if entry is None or entry['mtimes'] != mtimes:
+            entry = {'mtimes': mtimes, 'bands': {}}
+        self.images.put(image_id, entry)
+        return entry
+
+    def save(self, image_id=None):
+        """Write the new statistics of an image (or of all images)"""
+        with self.lock:
+            image_ids = list(self.unsaved) if image_id is None else [image_id]
+            for image_id in image_ids:
+                entry = self.unsaved.pop(image_id, None)
+                if entry is not None:
+                    self._write(image_id, entry)
+
+    def _write(self, image_id, entry):
+        filename = self._filename(image_id)
+        os.makedirs(self.directory, exist_ok=True)
+        temp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+        with open(temp_filename, 'w') as stream:
+            json.dump(entry, stream)
+        os.replace(temp_filename, filename)
+
+    def get(self, image_id, mtimes, key, band, percentiles=()):
+        """Get the statistics of a band
+
+        Args:
+            image_id: Id of the image.
+            mtimes: Modification times of the image files.
+            key: Key which identifies the band within the image (e.g. the band
+                expression).
+            band: The band as array. Only used if the statistics are not stored
+                yet.
+            percentiles: Percentiles (between 0 and 100) which are required.
+
+        Returns:
+            Dictionary with min, max and a dictionary of percentiles (with the
+            percentiles as keys).
+        """
+        hashed = hash_key(key)
+        with self.lock:
+            stats = self._load(image_id, mtimes)['bands'].get(hashed)
+            missing = [
+                p for p in percentiles
+                if stats is None or str(float(p)) not in stats['percentiles']
+            ]
+            if stats is not None and not missing:
+                self.hits += 1
+                return self._public(stats)
+            self.misses += 1
+
+        if stats is None:
+            stats = self.compute(band)
+        else:
+            stats = dict(stats, percentiles=dict(stats['percentiles']))
+        for p, value in zip(missing, self.percentiles(stats, band, missing)):
+            stats['percentiles'][str(float(p))] = value
+
+        with self.lock:
+            entry = self._load(image_id, mtimes)
+            entry['bands'][hashed] = stats
+            self.unsaved[image_id] = entry
+        return self._public(stats)
+
+    def _public(self, stats):
+        return {
+            'min': stats['min'],
+            'max': stats['max'],
+            'percentiles': {
+                float(p): value for p, value in stats['percentiles'].items()
+            },
+        }
+
+    def compute(self, band):
+        """Compute min, max and the histogram of a band"""
+        lower = float(np.min(band))
+        upper = float(np.max(band))
+
+        histogram = None
+        if np.isfinite(lower) and np.isfinite(upper):
+            histogram = np.histogram(
+                band, bins=self.BINS, range=(lower, upper)
+            )[0].tolist()
+
+        return {
+            'min': lower,
+            'max': upper,
+            'size': int(band.size),
+            'histogram': histogram,
+            'percentiles': {},
+        }
+
+    def percentiles(self, stats, band, percentiles):
+        """Compute percentiles exactly or approximate them from the histogram"""
+        if stats['size'] <= self.approximate_above or stats['histogram'] is None:
+            return np.percentile(band, percentiles).tolist()
+
+        counts = np.cumsum(stats['histogram'])
+        edges = np.linspace(stats['min'], stats['max'], self.BINS + 1)
+        values = []
+        for p in percentiles:
+            rank = p / 100 * (counts[-1] - 1)
+            index = min(
+                int(np.searchsorted(counts, rank, side='right')), self.BINS - 1
+            )
+            # Interpolate linearly within the bin:
+            before = counts[index-1] if index else 0
+            fraction = (rank - before) / max(counts[index] - before, 1)
+            values.append(float(
+                edges[index] + fraction * (edges[index+1] - edges[index])
+            ))
+        return values
+
+    def stats(self):
+        return {
+            'images': len(self.images),
+            'unsaved': len(self.unsaved),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class IngestedStore:
+    """Image files converted to memory-mapped bands with `iris ingest`
+
+    Each band of an image file is stored as uncompressed npy file together
+    with a pyramid of overviews (each level has half of the resolution of the
+    previous one, computed by averaging). Reading any window of any band is
+    then just slicing a memory-mapped array, no matter which format the
+    original file has. The meta file of an ingested image file contains the
+    modification time of the original file, so changed files are read from
+    the original again until they are ingested again.
+
+    Args:
+        directory: Directory of the store.
+        max_open: Maximum number of memory-mapped bands which are kept open.
+    """
+    VERSION = 1
+
+    def __init__(self, directory, max_open=256):
+        self.directory = join(directory, f'v{self.VERSION}')
+        self.metas = {}
+        self.arrays = LRUCache(max_open, sizeof=lambda array: 1)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, filename):
+        """Directory which holds the bands of an image file"""
+        return join(self.directory, hash_key(filename))
+
+    def get(self, filename, mtime):
+        """Get the meta information of an ingested image file
+
+        Returns:
+            Dictionary with the number of bands, the shape ([width, height]),
+            the data type and the number of levels of the ingested file or None
+            if the file was not ingested (or has changed since).
+        """
+        meta_file = join(self.path(filename), 'meta.json')
+        try:
+            meta_mtime = getmtime(meta_file)
+        except OSError:
+            self.misses += 1
+            return None
+
+        with self.lock:
+            if filename not in self.metas \
+                    or self.metas[filename][0] != meta_mtime:
+                try:
+                    with open(meta_file) as stream:
+                        meta = json.load(stream)
+                except (OSError, ValueError):
+                    meta = None
+                self.metas[filename] = (meta_mtime, meta)
+            meta = self.metas[filename][1]
+
+        if meta is None or meta['mtime'] != mtime:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return meta
+
+    def _band(self, filename, band, level):
+        key = (filename, band, level)
+        array = self.arrays.get(key)
+        if array is None:
+            array = np.load(
+                join(self.path(filename), f'B{band+1}_{level}.npy'),
+                mmap_mode='r', allow_pickle=False
+            )
+            self.arrays.put(key, array)
+        return array
+
+    def read(self, filename, meta, bands, window=None, downsample=1):
+        """Read bands without copying them
+
+        Args:
+            filename: Path to the original image file.
+            meta: Meta information returned by `get`.
+            bands: List of band indices (zero-based).
+            window: Same as in `Project.load_image`.
+            downsample: Same as in `Project.load_image`.
+
+        Returns:
+            List of read-only 2D arrays (views of the memory-mapped files).
+        """
+        width, height = meta['shape']
+        if window is None:
+            window = [0, 0, width, height]
+
+        # Use the smallest overview whose factor divides the downsampling
+        # factor and skip the remaining pixels:
+        level = 0
+        while level + 1 < meta['levels'] and downsample % 2**(level+1) == 0:
+            level += 1
+        factor = 2**level
+        step = downsample // factor
+        rows = ceil((window[3] - window[1]) / downsample)
+        columns = ceil((window[2] - window[0]) / downsample)
+        arrays = [self._band(filename, band, level) for band in bands]
+
+        # Take the pixel in the centre of each block of step x step pixels
+        # (like GDAL does) as long as the block lies within the image:
+        y, x = window[1] // factor, window[0] // factor
+        if y + step // 2 + (rows-1) * step < arrays[0].shape[0]:
+            y += step // 2
+        if x + step // 2 + (columns-1) * step < arrays[0].shape[1]:
+            x += step // 2
+
+        return [
+            array[y:y+rows*step:step, x:x+columns*step:step]
+            for array in arrays
+        ]
+
+    def put(self, filename, mtime, bands, min_size=256):
+        """Ingest an image file
+
+        Args:
+            filename: Path to the original image file.
+            mtime: Modification time of the original file.
+            bands: List of all bands of the file as 2D arrays.
+            min_size: Overviews are computed until the larger side of the
+                image is smaller than this.
+        """
+        directory = self.path(filename)
+        os.makedirs(directory, exist_ok=True)
+        suffix = f'{os.getpid()}.{threading.get_ident()}'
+
+        levels = 1
+        for index, band in enumerate(bands):
+            level = 0
+            while True:
+                band_file = join(directory, f'B{index+1}_{level}.npy')
+                np.save(f'{band_file}.{suffix}', band, allow_pickle=False)
+                os.replace(f'{band_file}.{suffix}.npy', band_file)
+                if max(band.shape) < 2 * min_size:
+                    break
+                band = self._downscale(band)
+                level += 1
+            levels = level + 1
+
+        height, width = bands[0].shape
+        meta_file = join(directory, 'meta.json')
+        with open(f'{meta_file}.{suffix}', 'w') as stream:
+            json.dump({
+                'source': filename,
+                'mtime': mtime,
+                'bands': len(bands),
+                'shape': [width, height],
+                'dtype': str(bands[0].dtype),
+                'levels': levels,
+            }, stream)
+        os.replace(f'{meta_file}.{suffix}', meta_file)
+
+    @staticmethod
+    def _downscale(band):
+        """Halve the resolution by averaging blocks of 2x2 pixels"""
+        height, width = band.shape
+        padded = np.pad(
+            band, ((0, height % 2), (0, width % 2)), mode='edge'
+        )
+        mean = padded.reshape(
+            padded.shape[0] // 2, 2, padded.shape[1] // 2, 2
+        ).mean(axis=(1, 3))
+        if np.issubdtype(band.dtype, np.integer) or band.dtype == bool:
+            mean = np.round(mean)
+        return mean.astype(band.dtype)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'open': len(self.arrays),
+        }
+
+
+class MetadataIndex:
+    """Parsed metadata of all images, persisted in the project directory
+
+    Parsing the metadata files (especially YAML) is slow. The index keeps the
+    parsed metadata of each image together with the modification time of its
+    file in memory and in a JSON file, so each file is parsed only once until
+    it changes. The index is filled lazily whenever the metadata of an image
+    is requested. The metadata is converted to JSON values when it is indexed
+    (see `to_json_value`).
+
+    Args:
+        filename: JSON file in which the index is stored.
+        save_interval: Minimum number of seconds between two saves when the
+            index is filled lazily.
+    """
+    VERSION = 2
+
+    def __init__(self, filename, save_interval=10):
+        self.filename = filename
+        self.save_interval = save_interval
+        self.images = None
+        self.dirty = False
+        self.saved_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.images is not None:
+            return
+        try:
+            with open(self.filename) as stream:
+                data = json.load(stream)
+            if data['version'] != self.VERSION:
+                raise ValueError('Outdated metadata index')
+            self.images = data['images']
+        except (OSError, ValueError, KeyError):
+            self.images = {}
+
+    def get(self, image_id, filename, mtime, parse):
+        """Get the metadata of an image
+
+        Args:
+            image_id: Id of the image.
+            filename: Path to the metadata file.
+            mtime: Modification time of the metadata file.
+            parse: Function which parses the metadata file. Only called if the
+                metadata is not indexed yet or the file has changed.
+
+        Returns:
+            The metadata as dictionary.
+        """
+        with self.lock:
+            self._load()
+            entry = self.images.get(image_id)
+            if entry is not None and entry['mtime'] == mtime:
+                self.hits += 1
+                return entry['metadata']
+            self.misses += 1
+
+        # Fresh and reloaded metadata must not differ (e.g. in their dates):
+        metadata = to_json_value(parse(filename))
+        with self.lock:
+            self.images[image_id] = {'mtime': mtime, 'metadata': metadata}
+            self.dirty = True
+            if time.time() - self.saved_at > self.save_interval:
+                self._save()
+        return metadata
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        temp_filename = f'{self.filename}.{os.getpid()}.{threading.get_ident()}'
+        with open(temp_filename, 'w') as stream:
+            json.dump({'version': self.VERSION, 'images': self.images}, stream)
+        os.replace(temp_filename, self.filename)
+        self.dirty = False
+        self.saved_at = time.time()
+
+    def stats(self):
+        return {
+            'images': len(self.images or {}),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class FeatureStore:
+    """Feature matrices of the AI model (see `predict_mask`)
+
+    The features of an image (bands, edges, superpixels, meshgrid) do not
+    depend on the pixels labelled by the user, so they are computed only once
+    per image, band selection and feature options. They are kept in memory
+    and, optionally, as npy files in the project directory which are
+    memory-mapped when they are needed again (e.g. after a restart). Files
+    older than the image files are outdated and computed again.
+
+    Args:
+        max_bytes: Memory budget.
+        directory: Directory for the npy files. If None, nothing is stored on
+            disk.
+    """
+    VERSION = 1
+
+    def __init__(self, max_bytes, directory=None):
+        self.memory = LRUCache(max_bytes, sizeof=lambda array: array.nbytes)
+        self.directory = None
+        if directory is not None:
+            self.directory = join(directory, f'v{self.VERSION}')
+        self.disk_hits = 0
+        self.computed = 0
+
+    def get(self, image_id, key, mtime, compute):
+        """Get the features of an image
+
+        Args:
+            image_id: Id of the image.
+            key: Key which identifies the band selection and feature options.
+            mtime: Latest modification time of the image files.
+            compute: Function which computes the features (without arguments).
+
+        Returns:
+            The features as read-only array.
+        """
+        features = self.memory.get((image_id, key, mtime))
+        if features is not None:
+            return features
+
+        filename = None
+        if self.directory is not None:
+            filename = join(self.directory, image_id, hash_key(key) + '.npy')
+            if exists(filename) and getmtime(filename) >= mtime:
+                self.disk_hits += 1
+                return np.load(filename, mmap_mode='r', allow_pickle=False)
+
+        features = compute()
+        features.flags.writeable = False
+        self.computed += 1
+        self.memory.put((image_id, key, mtime), features)
+
+        if filename is not None:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            temp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+            # np.save appends the extension:
+            np.save(temp_filename, features, allow_pickle=False)
+            os.replace(temp_filename + '.npy', filename)
+
+        return features
+
+    def stats(self):
+        return {
+            **self.memory.stats(),
+            'disk_hits': self.disk_hits,
+            'computed': self.computed,
+        }
+
+
+class SessionCache:
+    """Thread-safe cache of sessions which expire when they are not used
+
+    Args:
+        max_items: Maximum number of sessions. If exceeded, the least recently
+            used sessions are evicted.
+        ttl: Sessions which were not used for this number of seconds expire.
+    """
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        while self.items:
+            key, (_, used_at) = next(iter(self.items.items()))
+            if used_at > deadline:
+                break
+            del self.items[key]
+            self.expirations += 1
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._expire()
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self.items.pop(key)[0]
+            self.items[key] = (value, time.time())
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, time.time())
+            self._expire()
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+        return default if item is None else item[0]
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'max_items': self.max_items,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,341 @@
+"""Compile the band expressions of the views
+
+The band expressions (e.g. "edges($Sentinel2.B2+$Sentinel2.B3)*1.5") are
+parsed, validated and compiled once when the project is loaded. Rendering a
+view then only needs to evaluate the already compiled code.
+
+"""
+import ast
+from collections.abc import Mapping
+from copy import deepcopy
+import re
+import sys
+
+import numpy as np
+from skimage.filters import sobel
+from skimage.segmentation import felzenszwalb
+
+# All functions and constants which can be used in band expressions:
+FUNCTIONS = {
+    'max': np.max,
+    'min': np.min,
+    'mean': np.mean,
+    'median': np.median,
+    'log': np.log,
+    'exp': np.exp,
+    'sin': np.sin,
+    'cos': np.cos,
+    'PI': np.pi,
+    'edges': sobel,
+    'superpixels': felzenszwalb,
+}
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call,
+    ast.keyword, ast.Name, ast.Constant, ast.Subscript, ast.Load,
+    ast.operator, ast.unaryop, ast.cmpop,
+)
+# Python 3.8 wraps the subscript in an extra node:
+if sys.version_info < (3, 9):
+    ALLOWED_NODES += (ast.Index,)
+
+# Functions which work pixel by pixel, i.e. expressions which use only these
+# can be evaluated in chunks of rows:
+ELEMENTWISE_FUNCTIONS = {'log', 'exp', 'sin', 'cos'}
+
+# Only these nodes are worth to be evaluated once and shared between
+# expressions (names and constants are already cheap):
+SHAREABLE_NODES = (ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call)
+
+BAND_NAME = re.compile(r'^B\d+$')
+
+
+class Expression:
+    """A compiled band expression
+
+    Attributes:
+        source: The original expression from the project file.
+        bands: The bands required by this expression, e.g. "$B1" or
+            "$Sentinel2.B1".
+        code: The compiled code object.
+        elementwise: True if the expression works pixel by pixel (e.g.
+            "$B1*2", but not "edges($B1)" or "$B1/max($B1)").
+    """
+    def __init__(self, source, bands, code, elementwise=False):
+        self.source = source
+        self.bands = bands
+        self.code = code
+        self.elementwise = elementwise
+
+    def evaluate(self, environment):
+        return eval(self.code, {"__builtins__": None}, environment)
+
+
+class RenderEnvironment(dict):
+    """Namespace in which band expressions are evaluated
+
+    Bands are taken from the image when an expression needs them for the first
+    time, i.e. lazy images (see `iris.bands.LazyBands`) only read the bands
+    that are used. Subexpressions shared between several expressions are
+    evaluated lazily the first time they are needed and then reused for all
+    other expressions evaluated in the same environment.
+    """
+    def __init__(self, image, shared=None):
+        super().__init__(FUNCTIONS)
+        self.image = image
+        self.shared = shared or {}
+
+    def rows(self, start, stop):
+        """Get an environment with only some rows of all bands
+
+        Already evaluated shared subexpressions are sliced as well.
+        """
+        chunk = RenderEnvironment({
+            key: _slice_rows(value, start, stop)
+            for key, value in self.image.items()
+        }, shared=self.shared)
+        for key, value in self.items():
+            if key not in FUNCTIONS:
+                chunk[key] = _slice_rows(value, start, stop)
+        return chunk
+
+    def __missing__(self, name):
+        if '$' + name in self.image:
+            value = self.image['$' + name]
+        elif name in self.image:
+            # File identifiers (their bands are accessed by subscripts):
+            value = self.image[name]
+        elif name in self.shared:
+            value = eval(self.shared[name], {"__builtins__": None}, self)
+        else:
+            raise KeyError(name)
+
+        self[name] = value
+        return value
+
+
+def _slice_rows(value, start, stop):
+    if isinstance(value, np.ndarray) and value.ndim == 2:
+        return value[start:stop]
+    if isinstance(value, Mapping):
+        return {k: v[start:stop] for k, v in value.items()}
+    return value
+
+
+class ExpressionCompiler:
+    """Compile the band expressions of all views
+
+    Args:
+        file_ids: List of file identifiers if the images are distributed over
+            several files (e.g. ["Sentinel1", "Sentinel2"]). If None, the bands
+            are referred to directly (e.g. "$B1").
+    """
+    def __init__(self, file_ids=None):
+        self.file_ids = file_ids
+        self.shared = {}
+
+    def compile_views(self, views):
+        """Compile all expressions of all views
+
+        Args:
+            views: Dictionary of views (as in the project config).
+
+        Returns:
+            A dictionary with the view names as keys and a list of compiled
+            Expression objects as values (one per band of the view). Views
+            without band expressions (e.g. bingmaps) are skipped.
+        """
+        trees = {}
+        for name, view in views.items():
+            if 'data' not in view:
+                continue
+            trees[name] = [
+                (source, self.parse(source, name, i))
+                for i, source in enumerate(view['data'])
+            ]
+
+        shared_nodes = self._find_shared_nodes(
+            tree for view_trees in trees.values() for _, tree in view_trees
+        )
+        transformer = _SharedNodeTransformer(shared_nodes)
+
+        self.shared = {
+            shared_name: compile(
+                ast.fix_missing_locations(
+                    ast.Expression(body=transformer.visit_children(node))
+                ),
+                f'<shared expression {shared_name}>', 'eval'
+            )
+            for shared_name, node in shared_nodes.values()
+        }
+
+        compiled = {}
+        for name, view_trees in trees.items():
+            compiled[name] = []
+            for source, tree in view_trees:
+                bands = self._find_bands(tree)
+                elementwise = self._is_elementwise(tree)
+                tree = ast.fix_missing_locations(transformer.visit(tree))
+                compiled[name].append(Expression(
+                    source, bands, compile(tree, f'<view {name}>', 'eval'),
+                    elementwise=elementwise
+                ))
+
+        return compiled
+
+    def parse(self, source, view_name='', index=0):
+        """Parse and validate a single band expression
+
+        Raises:
+            Exception if the expression is invalid or unsafe.
+        """
+        expression = re.sub(r'\$(\w+)\.(\w+)', r'\1["\2"]', source)
+        expression = re.sub(r'\$(\w+)', r'\1', expression)
+
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+            self._check(tree)
+        except Exception as error:
+            raise Exception(
+                f"[CONFIG] Could not parse {index}th expression of view "
+                f"'{view_name}'!\nRaw expression: {source}\n"
+                f"Python expression: {expression}\nError: {error}"
+            )
+
+        return tree
+
+    def _check(self, tree):
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise SyntaxError(
+                    f"'{type(node).__name__}' is not allowed in band expressions!"
+                )
+
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name):
+                    raise SyntaxError("Only functions can be called!")
+                if not callable(FUNCTIONS.get(node.func.id)):
+                    raise NameError(
+                        f"Unknown function '{node.func.id}'! Allowed "
+                        "are: " + ", ".join(
+                            k for k, v in FUNCTIONS.items() if callable(v)
+                        )
+                    )
+            elif isinstance(node, ast.Subscript):
+                file_id, band = self._get_file_band(node)
+                if self.file_ids is None or file_id not in self.file_ids:
+                    raise NameError(f"Unknown file identifier '{file_id}'!")
+                if not BAND_NAME.match(band):
+                    raise NameError(f"Unknown band '{band}'!")
+            elif isinstance(node, ast.Name):
+                if node.id in FUNCTIONS:
+                    continue
+                if self.file_ids is None and BAND_NAME.match(node.id):
+                    continue
+                if self.file_ids is not None and node.id in self.file_ids:
+                    # Must be used as $FileIdentifier.B1 which is validated
+                    # with the subscript node above
+                    continue
+                raise NameError(f"Unknown variable '{node.id}'!")
+            elif isinstance(node, ast.Constant):
+                if not isinstance(node.value, (int, float, complex, str)):
+                    raise ValueError(f"Constant {node.value!r} is not allowed!")
+
+        # Make sure that file identifiers are only used with band names
+        # and strings only as band names:
+        subscript_children = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Subscript):
+                subscript_children.update(map(id, ast.walk(node)))
+        for node in ast.walk(tree):
+            if id(node) in subscript_children:
+                continue
+            if isinstance(node, ast.Name) and self.file_ids is not None \
+                    and node.id in self.file_ids:
+                raise NameError(
+                    f"File identifier '{node.id}' requires a band, e.g. "
+                    f"${node.id}.B1"
+                )
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                raise ValueError("Strings are not allowed in band expressions!")
+
+    def _get_file_band(self, node):
+        if not isinstance(node.value, ast.Name):
+            raise SyntaxError("Only bands can be indexed!")
+
+        index = node.slice
+        if sys.version_info < (3, 9) and isinstance(index, ast.Index):
+            index = index.value
+        if not isinstance(index, ast.Constant) or not isinstance(index.value, str):
+            raise SyntaxError("Only bands can be indexed!")
+
+        return node.value.id, index.value
+
+    def _find_bands(self, tree):
+        bands = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Subscript):
+                band = '${}.{}'.format(*self._get_file_band(node))
+            elif isinstance(node, ast.Name) and node.id not in FUNCTIONS \
+                    and self.file_ids is None:
+                band = '$' + node.id
+            else:
+                continue
+
+            if band not in bands:
+                bands.append(band)
+        return bands
+
+    def _is_elementwise(self, tree):
+        return all(
+            node.func.id in ELEMENTWISE_FUNCTIONS
+            for node in ast.walk(tree)
+            if isinstance(node, ast.Call)
+        )
+
+    def _find_shared_nodes(self, trees):
+        """Find subexpressions that occur more than once
+
+        Returns:
+            A dictionary with the dumped nodes as keys and a tuple of the
+            variable name and the node as values.
+        """
+        counts = {}
+        nodes = {}
+        for tree in trees:
+            for node in ast.walk(tree):
+                if not isinstance(node, SHAREABLE_NODES):
+                    continue
+                # Expressions without any band are cheap to evaluate:
+                if not any(
+                    isinstance(child, (ast.Name, ast.Subscript))
+                    and not (isinstance(child, ast.Name) and child.id in FUNCTIONS)
+                    for child in ast.walk(node)
+                ):
+                    continue
+                key = ast.dump(node)
+                counts[key] = counts.get(key, 0) + 1
+                nodes.setdefault(key, node)
+
+        return {
+            key: (f'_shared{i}', nodes[key])
+            for i, key in enumerate(k for k, c in counts.items() if c > 1)
+        }
+
+
+class _SharedNodeTransformer(ast.NodeTransformer):
+    """Replace shared subexpressions by their variable names"""
+    def __init__(self, shared_nodes):
+        self.shared_nodes = shared_nodes
+
+    def visit(self, node):
+        key = ast.dump(node)
+        if key in self.shared_nodes:
+            return ast.copy_location(
+                ast.Name(id=self.shared_nodes[key][0], ctx=ast.Load()), node
+            )
+        return super().visit(node)
+
+    def visit_children(self, node):
+        """Transform only the children of a node (not the node itself)"""
+        return self.generic_visit(deepcopy(node))
@@ -0,0 +1,104 @@
+"""Convert all image files of a project to memory-mapped bands (`iris ingest`)
+
+Most image formats have to be decoded (at least partially) whenever a band or
+a window of them is read. With `iris ingest`, each band of each image file is
+stored once as uncompressed, memory-mapped array with precomputed overviews in
+the project directory. Afterwards, IRIS reads any window of any band by
+slicing these arrays without decoding or copying anything. Image files which
+change after ingesting are read from the original file again until they are
+ingested again.
+
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+from os.path import getmtime
+import time
+
+from iris.project import project
+
+
+def ingest(project_file, jobs=None):
+    """Ingest all image files of a project
+
+    Args:
+        project_file: Path to the project file.
+        jobs: Number of worker processes. Defaults to the number of CPUs.
+    """
+    if project.file is None:
+        project.load_from(project_file)
+
+    jobs = jobs or os.cpu_count()
+    filenames = get_image_files()
+    print(
+        f'Ingesting {len(filenames)} files of {project["name"]} with {jobs} '
+        'processes...'
+    )
+
+    start = time.time()
+    ingested = 0
+    skipped = 0
+    with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=(project.file,),
+            # The server threads (e.g. the manifest rescans) are running
+            # already, forking could deadlock (see iris.jobs):
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {
+            executor.submit(ingest_file, filename): filename
+            for filename in filenames
+        }
+        for i, future in enumerate(as_completed(futures)):
+            filename = futures[future]
+            try:
+                if future.result():
+                    ingested += 1
+                else:
+                    skipped += 1
+            except Exception as error:
+                print(f'[ERROR] Could not ingest {filename}: {error}')
+                continue
+            print(f'[{i+1}/{len(filenames)}] Ingested {filename}')
+
+    print(
+        f'Ingested {ingested} files, {skipped} were already up to date '
+        f'({time.time()-start:.1f}s).'
+    )
+
+
+def _init_worker(project_file):
+    # The spawned processes need to load the project (without rescanning the
+    # manifest, which the main process does already):
+    if project.file is None:
+        project.load_from(project_file, rescan=False)
+
+
+def get_image_files():
+    """Get the paths to all image files of the project"""
+    paths = project['images']['path']
+    if not isinstance(paths, dict):
+        paths = {'': paths}
+
+    return [
+        path.format(id=image_id)
+        for image_id in project.image_ids
+        for path in paths.values()
+    ]
+
+
+def ingest_file(filename):
+    """Ingest one image file
+
+    Returns:
+        False if the file was ingested already and has not changed since.
+    """
+    mtime = getmtime(filename)
+    if project.ingested.get(filename, mtime) is not None:
+        return False
+
+    count = project.get_band_count(filename)
+    bands = project._read_bands_from_file(filename, list(range(count)))
+    project.ingested.put(
+        filename, mtime, bands, min_size=project['images']['tile_size']
+    )
+    return True
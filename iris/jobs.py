@@ -0,0 +1,375 @@
+"""Run the AI predictions as jobs in worker processes
+
+Training and predicting with the AI model is CPU-bound and takes up to several
+seconds. Running it in the web server would block all other requests (e.g. in
+production mode, where a single gevent server handles everything). Instead,
+predictions are submitted as jobs to a few worker processes. Clients poll the
+state of their job and fetch the result once it is done.
+
+Each user is always served by the same worker (slot), so the models kept for
+warm starts and the cached features stay in that worker. A user has at most
+one queued job: submitting a new one replaces the queued one, which would be
+outdated anyway.
+
+The CPU cores are shared between the running jobs: before a job is started, it
+is admitted by the `ThreadBudget`, which grants it a number of threads
+depending on the configured limits and on how many jobs run concurrently.
+Jobs wait in the order they arrived until threads are free.
+
+"""
+from collections import deque
+from concurrent.futures import (
+    CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor
+)
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+
+import gevent
+
+from iris.project import project
+from iris.worker import init_worker, run_job
+
+
+class Job:
+    """A submitted prediction
+
+    Args:
+        user_id: Id of the user who submitted the job.
+        image_id: Id of the image.
+        slot: Index of the worker which runs the job.
+        function: Function which runs the job.
+        args: Arguments for the function.
+    """
+    def __init__(self, user_id, image_id, slot, function, args):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.image_id = image_id
+        self.slot = slot
+        self.function = function
+        self.args = args
+        self.future = Future()
+        self.cancelled = False
+        self.replaced = False
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.threads = None
+        self.wall_time = None
+        self.cpu_time = None
+
+    @property
+    def state(self):
+        if self.replaced:
+            return 'replaced'
+        if self.cancelled:
+            return 'cancelled'
+        if self.future.done():
+            return 'failed' if self.future.exception() else 'done'
+        if self.future.running():
+            return 'running'
+        return 'queued'
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'image_id': self.image_id,
+            'state': self.state,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'threads': self.threads,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'error': str(self.future.exception())
+                if self.state == 'failed' else None,
+        }
+
+
+class ThreadBudget:
+    """Admission of jobs by the number of threads they may use
+
+    Args:
+        total: Number of threads all running jobs may use together.
+        per_job: Maximum number of threads of a single job.
+    """
+    def __init__(self, total, per_job):
+        self.total = total
+        self.per_job = per_job
+        self.free = total
+        self.running = 0
+        self.waiting = deque()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until threads are free and take a share of them
+
+        Jobs are admitted in the order they called this method. Each job gets
+        an equal share of all threads among the running and waiting jobs (but
+        at least one).
+
+        Returns:
+            The number of threads granted to the job.
+        """
+        ticket = object()
+        with self.condition:
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or not self.free:
+                self.condition.wait()
+            self.waiting.popleft()
+            share = self.total // (self.running + len(self.waiting) + 1)
+            threads = min(self.per_job, max(1, share), self.free)
+            self.free -= threads
+            self.running += 1
+            self.condition.notify_all()
+        return threads
+
+    def release(self, threads):
+        with self.condition:
+            self.free += threads
+            self.running -= 1
+            self.condition.notify_all()
+
+    def stats(self):
+        return {
+            'total': self.total,
+            'per_job': self.per_job,
+            'in_use': self.total - self.free,
+            'waiting': len(self.waiting),
+        }
+
+
+class Slot:
+    """A worker which runs the jobs of its queue one after another
+
+    The jobs are only handed over to the worker when it is idle and they were
+    admitted by the thread budget. Until then, they can still be replaced or
+    cancelled.
+
+    Args:
+        executor: Executor with a single worker.
+        budget: The `ThreadBudget` shared by all slots.
+    """
+    def __init__(self, executor, budget):
+        self.executor = executor
+        self.budget = budget
+        self.queue = deque()
+        self.condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, job):
+        with self.condition:
+            self.queue.append(job)
+            self.condition.notify()
+
+    def remove(self, job):
+        """Remove a queued job, returns False if it was started already
+
+        The caller has to cancel the future of the job, after marking why it
+        was removed (so that `Job.state` never sees a cancelled future alone).
+        """
+        with self.condition:
+            if job not in self.queue:
+                return False
+            self.queue.remove(job)
+        return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+            threads = self.budget.acquire()
+            with self.condition:
+                # The job might have been removed while waiting for admission:
+                job = self.queue.popleft() if self.queue else None
+            if job is None or not job.future.set_running_or_notify_cancel():
+                self.budget.release(threads)
+                continue
+            job.started_at = time.time()
+            job.threads = threads
+            try:
+                result, job.wall_time, job.cpu_time = self.executor.submit(
+                    run_job, job.function, job.args, threads
+                ).result()
+            except BaseException as error:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+            finally:
+                self.budget.release(threads)
+
+
+class JobQueue:
+    """Worker slots which run the predictions of the users"""
+    def __init__(self):
+        self.config = None
+        self.budget = None
+        self.slots = []
+        self.jobs = {}
+        self.queued = {}
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.replaced = 0
+        self.cancelled = 0
+
+    def init(self, config):
+        """Configure the worker slots (they are started on the first job)
+
+        Args:
+            config: The jobs section of the project config.
+        """
+        for name in ['workers', 'threads', 'threads_per_job']:
+            value = config[name]
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise Exception(
+                    f'[CONFIG] jobs.{name} must be a non-negative integer!'
+                )
+        n_slots = config['workers'] or 1
+        total = config['threads'] or max(get_cpu_count(), n_slots)
+        # By default, each slot gets its share of the threads, so that all
+        # slots can run a job at the same time:
+        per_job = config['threads_per_job'] or max(1, total // n_slots)
+        self.config = config
+        self.budget = ThreadBudget(total, min(per_job, total))
+
+    def _get_slot(self, user_id):
+        with self.lock:
+            if not self.slots:
+                if self.config['workers']:
+                    self.slots = [
+                        Slot(ProcessPoolExecutor(
+                            max_workers=1, initializer=init_worker,
+                            initargs=(project.file,),
+                            # Forked workers would inherit the thread pools,
+                            # locks and open datasets of the server without
+                            # their threads, which can deadlock:
+                            mp_context=multiprocessing.get_context('spawn')
+                        ), self.budget)
+                        for _ in range(self.config['workers'])
+                    ]
+                else:
+                    # Run the jobs in a thread of the server process:
+                    self.slots = [Slot(ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix='jobs'
+                    ), self.budget)]
+        return hash(str(user_id)) % len(self.slots)
+
+    def submit(self, user_id, image_id, function, *args):
+        """Submit a job
+
+        A queued job of the same user is replaced by the new one.
+
+        Args:
+            user_id: Id of the user.
+            image_id: Id of the image.
+            function: Function which runs the job (must be picklable, i.e.
+                defined on module level of a module which the workers can
+                import without the web app, e.g. `iris.ai`). It is called
+                with the granted number of threads as keyword argument
+                `threads`. Its return value is the result.
+            args: Arguments for the function.
+
+        Returns:
+            The submitted `Job`.
+        """
+        slot = self._get_slot(user_id)
+        job = Job(user_id, image_id, slot, function, args)
+        job.future.add_done_callback(
+            lambda future: setattr(job, 'finished_at', time.time())
+        )
+        with self.lock:
+            self._forget_old_jobs()
+            previous = self.queued.get(user_id)
+            if previous is not None and self.slots[slot].remove(previous):
+                previous.replaced = True
+                previous.future.cancel()
+                self.replaced += 1
+            self.jobs[job.id] = job
+            self.queued[user_id] = job
+            self.submitted += 1
+            self.slots[slot].put(job)
+        return job
+
+    def get(self, job_id, user_id):
+        """Get a job of a user or None if it does not exist (anymore)"""
+        job = self.jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    def cancel(self, job):
+        """Cancel a job. The result of a running job is discarded."""
+        if job.state in ['queued', 'running']:
+            # A running job cannot be stopped, its result is discarded:
+            removed = self.slots[job.slot].remove(job)
+            job.cancelled = True
+            if removed:
+                job.future.cancel()
+            self.cancelled += 1
+
+    def wait(self, job, interval=0.1):
+        """Wait cooperatively for the result of a job
+
+        Blocking on the future would block the whole event loop of the gevent
+        server (which does not monkey-patch threading). Instead, the state of
+        the job is polled and other requests are served in between.
+
+        Raises:
+            CancelledError if the job was cancelled or replaced.
+        """
+        while not job.future.done():
+            gevent.sleep(interval)
+        return self.result(job)
+
+    def result(self, job, timeout=None):
+        """Wait for the result of a job
+
+        Raises:
+            CancelledError if the job was cancelled or replaced.
+        """
+        result = job.future.result(timeout=timeout)
+        if job.cancelled:
+            raise CancelledError()
+        return result
+
+    def _forget_old_jobs(self):
+        deadline = time.time() - self.config['result_ttl']
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and job.finished_at < deadline:
+                del self.jobs[job_id]
+                if self.queued.get(job.user_id) is job:
+                    del self.queued[job.user_id]
+
+    def stats(self):
+        states = {}
+        wall_time = 0
+        cpu_time = 0
+        for job in list(self.jobs.values()):
+            states[job.state] = states.get(job.state, 0) + 1
+            if job.wall_time is not None:
+                wall_time += job.wall_time
+                cpu_time += job.cpu_time
+        return {
+            'workers': len(self.slots),
+            'threads': self.budget.stats(),
+            'jobs': states,
+            # Of the jobs which finished within the last result_ttl seconds:
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'submitted': self.submitted,
+            'replaced': self.replaced,
+            'cancelled': self.cancelled,
+        }
+
+
+def get_cpu_count():
+    """Get the number of CPU cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+jobs = JobQueue()
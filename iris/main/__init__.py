@@ -1,15 +1,39 @@
+from datetime import datetime, timezone
 import io
 import json
+from math import ceil, sqrt
+import re
+import struct
 
 import flask
 import markupsafe
 import numpy as np
-from PIL import Image as PILImage
-from skimage.transform import resize
+from PIL import Image as PILImage, features as pil_features
 
+from iris.cache import hash_key
 from iris.models import db, Action
+from iris.prefetch import prefetcher
 from iris.project import project
 from iris.user import requires_auth
+from iris.utils import resize_image
+
+# Files packed with pack_files (not application/octet-stream to avoid that
+# flask-compress compresses the already compressed images again):
+CONTAINER_MIMETYPE = 'application/vnd.iris.container'
+
+# Image formats which can be requested by the clients:
+IMAGE_FORMATS = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+# Limits of the thumbnail and contact sheet routes (the sprite of a contact
+# sheet has to fit into memory):
+MAX_THUMBNAIL_SIZE = 1024
+MAX_CONTACT_SHEET_IMAGES = 1000
+
+# WebP is an optional feature of Pillow:
+PIL_WEBP = pil_features.check('webp')
 
 main_app = flask.Blueprint(
     'main', __name__,
@@ -25,8 +49,223 @@ def index():
 
 @main_app.route('/image/<image_id>/<view>')
 def image(image_id, view):
-    image = project.render_image(image_id, project['views'][view])
-    return array_to_png(image)
+    if not project.has_image(image_id):
+        return flask.make_response('Unknown image id!', 404)
+    if view not in project['views']:
+        return flask.make_response('Unknown view!', 404)
+    encoding = get_encoding()
+    if encoding is None:
+        return flask.make_response('Unknown image format!', 400)
+
+    view = project['views'][view]
+
+    def render():
+        with prefetcher.live_request():
+            return image_response(get_view_image(image_id, view, encoding))
+
+    return conditional_response(
+        get_view_cache_key(image_id, view, encoding),
+        project.get_view_mtime(image_id), render
+    )
+
+@main_app.route('/tile/<image_id>/<view>/<int:z>/<int:x>/<int:y>')
+def tile(image_id, view, z, x, y):
+    if not project.has_image(image_id):
+        return flask.make_response('Unknown image id!', 404)
+    if view not in project['views']:
+        return flask.make_response('Unknown view!', 404)
+    encoding = get_encoding()
+    if encoding is None:
+        return flask.make_response('Unknown image format!', 400)
+
+    view = project['views'][view]
+
+    def render():
+        with prefetcher.live_request():
+            data = get_tile_image(image_id, view, z, x, y, encoding)
+        if data is None:
+            return flask.make_response('Tile is outside of the image!', 404)
+        return image_response(data)
+
+    return conditional_response(
+        get_tile_cache_key(image_id, view, encoding, z, x, y),
+        project.get_view_mtime(image_id), render
+    )
+
+@main_app.route('/views/<image_id>')
+def views(image_id):
+    """Get several views of an image with one request
+
+    The views are given by repeating the query parameter `view`, e.g.
+    /views/<image_id>?view=RGB&view=Snow. All views that are not cached are
+    rendered together from one load of the image. The views are returned
+    packed in one binary container (see `pack_files`).
+    """
+    if not project.has_image(image_id):
+        return flask.make_response('Unknown image id!', 404)
+
+    names = flask.request.args.getlist('view')
+    for name in names:
+        if name not in project['views'] or 'data' not in project['views'][name]:
+            return flask.make_response(f'Unknown view {name}!', 404)
+    encoding = get_encoding()
+    if encoding is None:
+        return flask.make_response('Unknown image format!', 400)
+
+    views = [project['views'][name] for name in names]
+
+    def render():
+        with prefetcher.live_request():
+            files = get_views_images(image_id, views, encoding)
+
+        response = flask.make_response(pack_files({
+            name: (files[name], get_mimetype(files[name])) for name in names
+        }))
+        response.headers.set('Content-Type', CONTAINER_MIMETYPE)
+        response.vary.add('Accept')
+        return response
+
+    return conditional_response(
+        tuple(get_view_cache_key(image_id, view, encoding) for view in views),
+        project.get_view_mtime(image_id), render
+    )
+
+def get_views_images(image_id, views, encoding=None):
+    """Get encoded views, either from the cache or freshly rendered
+
+    All views that are neither cached nor baked are rendered together.
+
+    Args:
+        image_id: The id of the image.
+        views: List of views (as in the project config).
+        encoding: Image encoding (see `get_encoding`). Defaults to the encoding
+            of the project.
+
+    Returns:
+        A dictionary with the view names as keys and the encoded images as
+        values.
+    """
+    encoding = encoding or get_default_encoding()
+
+    files = {}
+    missing = []
+    for view in views:
+        key = get_view_cache_key(image_id, view, encoding)
+        data = project.view_cache.get(key)
+        if data is None:
+            # Maybe the view has been rendered already with `iris bake`:
+            data = project.baked.get(image_id, view['name'], key)
+            if data is None:
+                missing.append(view)
+                continue
+            project.view_cache.put(key, data)
+        files[view['name']] = data
+
+    if missing:
+        for name, array in project.render_views(image_id, missing).items():
+            files[name] = encode_image(array, encoding)
+            project.view_cache.put(
+                get_view_cache_key(image_id, project['views'][name], encoding),
+                files[name]
+            )
+
+    return files
+
+def get_view_cache_key(image_id, view, encoding):
+    """Key which identifies an encoded view of an image"""
+    return (*project.get_view_key(image_id, view), get_encoding_key(encoding))
+
+def get_tile_cache_key(image_id, view, encoding, z, x, y):
+    """Key which identifies an encoded map tile of a view (the geometry of
+    the tiles depends on the tile size)"""
+    return (
+        *get_view_cache_key(image_id, view, encoding),
+        project['images']['tile_size'], z, x, y
+    )
+
+def get_view_image(image_id, view, encoding=None):
+    """Get the encoded view, either from the cache or freshly rendered"""
+    return get_views_images(image_id, [view], encoding)[view['name']]
+
+def get_tile_image(image_id, view, z, x, y, encoding=None):
+    """Get an encoded map tile or None if the tile is outside of the image"""
+    encoding = encoding or get_default_encoding()
+
+    key = get_tile_cache_key(image_id, view, encoding, z, x, y)
+    data = project.view_cache.get(key)
+    if data is None:
+        array = project.render_tile(image_id, view, z, x, y)
+        if array is None:
+            return None
+        data = encode_image(array, encoding)
+        project.view_cache.put(key, data)
+    return data
+
+def get_thumbnail_image(image_id, encoding=None, size=None):
+    """Get the encoded thumbnail or None if the project has no thumbnails
+
+    Args:
+        image_id: The id of the image.
+        encoding: Image encoding (see `get_encoding`). Defaults to the encoding
+            of the project.
+        size: If given, the thumbnail is resized to this shape (height,
+            width). Resized thumbnails are cached as well.
+    """
+    encoding = encoding or get_default_encoding()
+
+    key = project.get_thumbnail_key(image_id)
+    if key is None:
+        return None
+    key = (*key, get_encoding_key(encoding))
+    if size is not None:
+        key = (*key, tuple(size))
+
+    data = project.view_cache.get(key)
+    if data is None:
+        if size is None:
+            data = project.baked.get(image_id, 'thumbnail', key)
+            if data is None:
+                data = encode_image(project.get_thumbnail(image_id), encoding)
+        else:
+            data = encode_image(
+                resize_image(get_thumbnail_array(image_id), shape=size),
+                encoding
+            )
+        project.view_cache.put(key, data)
+    return data
+
+def get_thumbnail_array(image_id):
+    """Get the thumbnail as array (decoded from the cached thumbnail if
+    possible instead of rendering or reading it again)"""
+    data = get_thumbnail_image(image_id)
+    return np.asarray(PILImage.open(io.BytesIO(data)))
+
+def get_contact_sheet(image_ids, size, encoding=None):
+    """Pack the thumbnails of several images into one image (a sprite)
+
+    Args:
+        image_ids: List of image ids.
+        size: Shape (height, width) of each thumbnail in the sprite.
+        encoding: Image encoding (see `get_encoding`).
+
+    Returns:
+        The encoded sprite and a dictionary with the image ids as keys and
+        their position [x, y, width, height] in the sprite as values.
+    """
+    height, width = size
+    columns = max(1, min(len(image_ids), ceil(sqrt(len(image_ids)))))
+    rows = ceil(len(image_ids) / columns)
+    sprite = np.zeros((max(rows, 1)*height, columns*width, 3), dtype='uint8')
+
+    offsets = {}
+    for i, image_id in enumerate(image_ids):
+        array = PILImage.fromarray(get_thumbnail_array(image_id))
+        array = resize_image(np.asarray(array.convert('RGB')), shape=size)
+        y, x = (i // columns) * height, (i % columns) * width
+        sprite[y:y+height, x:x+width] = array
+        offsets[image_id] = [x, y, width, height]
+
+    return encode_image(sprite, encoding), offsets
 
 @main_app.route('/image_info/<image_id>')
 @requires_auth
@@ -86,37 +325,345 @@ def set_action_info(action_id):
 
 @main_app.route('/metadata/<image_id>', methods=['GET'])
 def metadata(image_id):
-    metadata = project.get_metadata(image_id)
+    key = project.get_metadata_key(image_id)
+    if key is None:
+        return flask.make_response("No metadata found!", 404)
+
+    safe_html = flask.request.args.get('safe_html', False)
+
+    def render():
+        metadata = project.get_metadata(image_id)
+
+        if not metadata:
+            return flask.make_response("No metadata found!", 404)
+
+        if safe_html:
+            metadata = {
+                k: markupsafe.Markup(str(v))
+                for k, v in metadata.items()
+            }
+
+        return flask.jsonify(metadata)
 
-    if not metadata:
+    return conditional_response((*key, bool(safe_html)), key[1], render)
+
+@main_app.route('/metadata', methods=['GET'])
+def metadata_bulk():
+    """Metadata of many images at once, optionally filtered and sorted
+
+    Query parameters:
+        image_id: Images to return (can be given several times). Defaults to
+            all images.
+        filter: Condition like "resolution<=20" or "spacecraft_id==Sentinel2"
+            (can be given several times). Values are parsed as JSON if
+            possible, e.g. numbers, and used as strings otherwise.
+        sort: Field to sort by, prefixed with "-" for descending order.
+        start, count: Return only a part of the (filtered and sorted) images.
+    """
+    if not project['images']['metadata']:
         return flask.make_response("No metadata found!", 404)
 
-    if flask.request.args.get('safe_html', False):
-        metadata = {
-            k: markupsafe.Markup(str(v))
-            for k, v in metadata.items()
-        }
+    image_ids = flask.request.args.getlist('image_id') or None
+    if image_ids is not None and not all(map(project.has_image, image_ids)):
+        return flask.make_response('Unknown image id!', 404)
+
+    filters = []
+    for condition in flask.request.args.getlist('filter'):
+        match = re.fullmatch(r'([^<>=!]+)(==|!=|<=|>=|<|>)(.*)', condition)
+        if match is None:
+            return flask.make_response(f'Invalid filter "{condition}"!', 400)
+        field, op, value = match.groups()
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        filters.append((field.strip(), op, value))
+
+    images = project.query_metadata(
+        image_ids, filters, flask.request.args.get('sort', None)
+    )
+
+    start = flask.request.args.get('start', 0, type=int)
+    count = flask.request.args.get('count', None, type=int)
+    end = None if count is None else start + count
 
-    return flask.jsonify(metadata)
+    return flask.jsonify({
+        'total': len(images),
+        'images': [
+            {'id': image_id, 'metadata': metadata}
+            for image_id, metadata in images[start:end]
+        ]
+    })
 
 @main_app.route('/thumbnail/<image_id>', methods=['GET'])
 def thumbnail(image_id):
-    size = flask.request.args.get("size", None)
-    array = project.get_thumbnail(image_id)
+    if not project.has_image(image_id):
+        return flask.make_response('Unknown image id!', 404)
+    size = get_size()
+    if size is False:
+        return flask.make_response('Invalid size!', 400)
+    encoding = get_encoding()
+    if encoding is None:
+        return flask.make_response('Unknown image format!', 400)
 
-    if size is not None:
-        print(size, tuple(size.split("x")))
-        size = map(int, size.split("x"))
-        array = resize(array, size)
+    key = project.get_thumbnail_key(image_id)
+    if key is None:
+        return flask.make_response('No thumbnail found!', 404)
 
-    return array_to_png(array)
+    def render():
+        with prefetcher.live_request():
+            return image_response(
+                get_thumbnail_image(image_id, encoding, size)
+            )
+
+    return conditional_response(
+        (*key, size, get_encoding_key(encoding)), key[2], render
+    )
+
+@main_app.route('/contact_sheet', methods=['GET'])
+def contact_sheet():
+    """Thumbnails of many images packed into one sprite
+
+    The images are selected with the query parameters `image_id` (can be given
+    several times) or `start` and `count` (position in the list of all
+    images). The response is a container (see `pack_files`) with the sprite
+    and a header which contains the position of each thumbnail in the sprite.
+    """
+    image_ids = flask.request.args.getlist('image_id')
+    if not image_ids:
+        start = flask.request.args.get('start', 0, type=int)
+        count = flask.request.args.get('count', 100, type=int)
+        image_ids = project.image_ids[start:start+count]
+    if len(image_ids) > MAX_CONTACT_SHEET_IMAGES:
+        return flask.make_response(
+            f'At most {MAX_CONTACT_SHEET_IMAGES} images per contact sheet!',
+            400
+        )
+    if not all(map(project.has_image, image_ids)):
+        return flask.make_response('Unknown image id!', 404)
+    size = get_size()
+    if size is False:
+        return flask.make_response('Invalid size!', 400)
+    size = size or (64, 64)
+    encoding = get_encoding()
+    if encoding is None:
+        return flask.make_response('Unknown image format!', 400)
+
+    keys = [project.get_thumbnail_key(image_id) for image_id in image_ids]
+    if not keys or None in keys:
+        return flask.make_response('No thumbnails found!', 404)
+
+    def render():
+        with prefetcher.live_request():
+            sprite, offsets = get_contact_sheet(image_ids, size, encoding)
+        response = flask.make_response(pack_files(
+            {'sprite': (sprite, get_mimetype(sprite))}, thumbnails=offsets
+        ))
+        response.headers.set('Content-Type', CONTAINER_MIMETYPE)
+        return response
+
+    return conditional_response(
+        (tuple(keys), size, get_encoding_key(encoding)),
+        max(key[2] for key in keys), render
+    )
+
+def get_size():
+    """Get the size requested with the query parameter `size`
+
+    Returns:
+        The size as tuple (height, width), None if no size was requested or
+        False if the size is invalid.
+    """
+    size = flask.request.args.get('size', None)
+    if size is None:
+        return None
+
+    try:
+        height, width = map(int, size.split('x'))
+    except ValueError:
+        return False
+    if not 0 < height <= MAX_THUMBNAIL_SIZE or not 0 < width <= MAX_THUMBNAIL_SIZE:
+        return False
+    return height, width
+
+def get_default_encoding():
+    """Get the image encoding configured in the project"""
+    return dict(project['images']['encoding'])
+
+def get_encoding():
+    """Get the image encoding for the current request
+
+    The format can be requested explicitly with the query parameter `format`
+    (png, webp or jpeg). Otherwise, it is negotiated via the `Accept` header:
+    the format of the project is used if the client accepts it, lossless
+    formats otherwise.
+
+    Returns:
+        The encoding as dictionary or None if an unknown format was requested.
+    """
+    encoding = get_default_encoding()
+    if not flask.has_request_context():
+        return encoding
+
+    requested = flask.request.args.get('format', None)
+    if requested is not None:
+        if requested not in IMAGE_FORMATS:
+            return None
+        encoding['format'] = requested
+        return encoding
+
+    if not flask.request.accept_mimetypes:
+        # Clients without Accept header accept everything:
+        return encoding
+
+    # best_match() prefers the most specific match, i.e. it would choose
+    # image/webp over image/* for browsers which accept both:
+    accepted = flask.request.accept_mimetypes
+    if accepted.quality(IMAGE_FORMATS[encoding['format']]) > 0:
+        return encoding
+
+    best = accepted.best_match(
+        [IMAGE_FORMATS[format] for format in ['png', 'webp']],
+        default='image/png'
+    )
+    encoding['format'] = next(
+        format for format, mimetype in IMAGE_FORMATS.items()
+        if mimetype == best
+    )
+    return encoding
+
+def get_encoding_key(encoding):
+    """Hashable key of an encoding (to be used in cache keys)"""
+    return tuple(sorted(encoding.items()))
+
+def get_mimetype(data):
+    """Get the mimetype of an encoded image from its magic bytes"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    return 'image/png'
+
+def encode_image(array, encoding=None):
+    """Encode an image array
+
+    Args:
+        array: Image as uint8 array (fastest) or float array with values
+            between 0 and 1.
+        encoding: Dictionary with the format (png, webp or jpeg) and its
+            options (see images : encoding in the docs). Defaults to the
+            encoding of the project.
+
+    Returns:
+        The encoded image as bytes. JPEG is only used for RGB and greyscale
+        images and WebP only if Pillow supports it, PNG otherwise.
+    """
+    encoding = encoding or get_default_encoding()
 
-def array_to_png(array):
     if issubclass(array.dtype.type, np.floating):
-        array = np.clip(array * 255., 0, 255).astype('uint8')
+        scaled = np.multiply(array, 255., dtype=np.float32)
+        np.clip(scaled, 0, 255, out=scaled)
+        array = scaled.astype('uint8')
+
+    format = encoding['format']
+    if format == 'jpeg' and not (array.ndim == 2 or array.shape[-1] == 3):
+        format = 'png'
+    if format == 'webp' and not PIL_WEBP:
+        format = 'png'
 
     img = PILImage.fromarray(array) # convert arr to image
     file_object = io.BytesIO()   # create file in memory
-    img.save(file_object, 'PNG') # save PNG in file in memory
-    file_object.seek(0)          # move to beginning of file
-    return flask.send_file(file_object,  mimetype='image/png')
+    if format == 'webp':
+        img.save(
+            file_object, 'WEBP', lossless=encoding['webp_lossless'],
+            quality=encoding['quality']
+        )
+    elif format == 'jpeg':
+        img.save(file_object, 'JPEG', quality=encoding['quality'])
+    else:
+        img.save(
+            file_object, 'PNG', compress_level=encoding['png_compression']
+        )
+    return file_object.getvalue()
+
+def encode_png(array):
+    return encode_image(array, {**get_default_encoding(), 'format': 'png'})
+
+def pack_files(files, **header):
+    """Pack several files into one binary container
+
+    The container starts with the length of the header (uint32, little
+    endian), followed by the header in JSON and then the data of all files.
+    The header contains the name, mimetype, offset (relative to the end of the
+    header) and length of each file plus any further keyword arguments.
+
+    Args:
+        files: Dictionary with the names as keys and tuples of the data (bytes)
+            and the mimetype as values.
+
+    Returns:
+        The container as bytes.
+    """
+    header['files'] = []
+    offset = 0
+    for name, (data, mimetype) in files.items():
+        header['files'].append({
+            'name': name, 'type': mimetype, 'offset': offset,
+            'length': len(data)
+        })
+        offset += len(data)
+
+    header = json.dumps(header).encode('utf-8')
+    return b''.join([
+        struct.pack('<I', len(header)), header,
+        *[data for data, _ in files.values()]
+    ])
+
+def conditional_response(key, mtime, render):
+    """Answer a request with cache validators (ETag and Last-Modified)
+
+    If the client has still a fresh copy (If-None-Match or If-Modified-Since),
+    the response is "304 Not Modified" and `render` is not called at all.
+
+    Args:
+        key: Key which identifies the content of the response. Used to create
+            the ETag, so it must change whenever the content changes.
+        mtime: Modification time (timestamp) of the content.
+        render: Function which creates the full response.
+    """
+    etag = hash_key(key)
+    request = flask.request
+    # If-None-Match takes precedence over If-Modified-Since:
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        not_modified = int(mtime) <= request.if_modified_since.timestamp()
+    else:
+        not_modified = False
+
+    if not_modified:
+        response = flask.make_response('', 304)
+    else:
+        response = render()
+        if response.status_code != 200:
+            return response
+
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(int(mtime), timezone.utc)
+    max_age = project['cache']['http']['max_age']
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        # The browser may keep the response but has to revalidate it:
+        response.cache_control.no_cache = True
+    response.vary.add('Accept')
+    return response
+
+def image_response(data):
+    response = flask.make_response(data)
+    response.headers.set('Content-Type', get_mimetype(data))
+    response.vary.add('Accept')
+    return response
+
+def array_to_png(array):
+    return image_response(encode_png(array))
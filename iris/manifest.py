@@ -0,0 +1,228 @@
+"""Persistent list of all images of a project (the manifest)
+
+Globbing `images:path` on every startup is slow for large projects (e.g. with
+hundred thousands of images on network-attached storage). The manifest stores
+the image ids together with the sizes, modification times, number of bands and
+shapes of their files in the project directory, so the headers of the files
+do not have to be read again either. It also remembers the listing and
+modification time of each directory it scanned, so a rescan only lists the
+directories which have changed since. The files of known images are only
+stat'ed on a rescan, their headers are read again if they have changed.
+
+"""
+from fnmatch import fnmatch
+from glob import has_magic
+import json
+import os
+from os.path import dirname, join, normpath
+import threading
+import time
+
+
+class Manifest:
+    """Image ids and file information of a project
+
+    Args:
+        filename: JSON file in which the manifest is stored. If None, the
+            manifest is not persisted.
+        paths: The images:path of the project (a string or a dictionary of
+            strings with the placeholder "{id}").
+        describe: Function which gets the path to an image file and returns a
+            dictionary with the number of "bands" and the "shape" (width and
+            height) read from the header of the file.
+    """
+    VERSION = 1
+
+    def __init__(self, filename, paths, describe):
+        self.filename = filename
+        self.paths = paths if isinstance(paths, dict) else {'': paths}
+        self.describe = describe
+        # The image ids are extracted from the paths of the first file:
+        self.pattern = list(self.paths.values())[0]
+        self.directories = {}
+        self.images = {}
+        # The information of each file by its path:
+        self.files = {}
+        self.lock = threading.Lock()
+        self.scans = 0
+        self.last_scan = None
+
+    @property
+    def image_ids(self):
+        return sorted(self.images)
+
+    def load(self):
+        """Load the manifest from its file
+
+        Returns:
+            True if the manifest was loaded, False if it does not exist yet or
+            is outdated (e.g. because images:path was changed).
+        """
+        if self.filename is None:
+            return False
+
+        try:
+            with open(self.filename) as stream:
+                data = json.load(stream)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('version') != self.VERSION or data.get('paths') != self.paths:
+            return False
+
+        self.directories = data['directories']
+        self.images = data['images']
+        self.files = self._index_files(self.images)
+        return True
+
+    def save(self):
+        if self.filename is None:
+            return
+
+        os.makedirs(dirname(self.filename), exist_ok=True)
+        temp_filename = f'{self.filename}.{os.getpid()}.{threading.get_ident()}'
+        with open(temp_filename, 'w') as stream:
+            json.dump({
+                'version': self.VERSION,
+                'paths': self.paths,
+                'directories': self.directories,
+                'images': self.images,
+            }, stream)
+        os.replace(temp_filename, self.filename)
+
+    def scan(self):
+        """Find all images and update the manifest
+
+        Only directories which were modified since the last scan are listed
+        again. The files of all images are checked for changes, their headers
+        are only read if they are new or have changed.
+
+        Returns:
+            True if images were added or removed.
+        """
+        # Only one scan at a time, a rescan in the background must not
+        # interfere with one in the foreground:
+        with self.lock:
+            return self._scan()
+
+    def _scan(self):
+        before, _, after = normpath(self.pattern).partition("{id}")
+        visited = set()
+        changed_directories = set()
+
+        images = {}
+        for path in self._glob(
+                self.pattern.format(id="*"), visited, changed_directories):
+            # The id is the part of the path that matched the placeholder:
+            if not path.startswith(before) or not path.endswith(after):
+                continue
+            image_id = path[len(before):len(path)-len(after)]
+            # Files can be rewritten without changing the modification time
+            # of their directory, so each file has to be checked:
+            images[image_id] = self._describe_image(
+                image_id, self.images.get(image_id)
+            )
+
+        # Forget directories which do not exist or match anymore:
+        self.directories = {
+            directory: entry for directory, entry in self.directories.items()
+            if directory in visited
+        }
+
+        changed = set(images) != set(self.images)
+        self.images = images
+        self.files = self._index_files(images)
+        self.scans += 1
+        self.last_scan = time.time()
+        self.save()
+        return changed
+
+    def _describe_image(self, image_id, record):
+        record = record or {'files': {}}
+        files = {}
+        for file_id, path in self.paths.items():
+            path = path.format(id=image_id)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            info = record['files'].get(file_id)
+            if info is None or info['size'] != stat.st_size \
+                    or info['mtime'] != stat.st_mtime:
+                info = {'size': stat.st_size, 'mtime': stat.st_mtime}
+                try:
+                    info.update(self.describe(path))
+                except Exception as error:
+                    print(f'[WARNING] Could not read header of {path}: {error}')
+            files[file_id] = info
+
+        return {'files': files}
+
+    def _index_files(self, images):
+        return {
+            self.paths[file_id].format(id=image_id): info
+            for image_id, record in images.items()
+            for file_id, info in record['files'].items()
+            if file_id in self.paths
+        }
+
+    def _glob(self, pattern, visited, changed_directories):
+        """Same as glob.glob but with cached directory listings"""
+        parts = normpath(pattern).split(os.sep)
+        paths = [parts[0] or os.sep]
+        for i, part in enumerate(parts[1:], 1):
+            last = i == len(parts) - 1
+            if not has_magic(part) and not last:
+                paths = [join(path, part) for path in paths]
+                continue
+
+            matches = []
+            for path in paths:
+                names = self._listdir(path, visited, changed_directories)
+                if has_magic(part):
+                    matches.extend(
+                        join(path, name) for name in names
+                        if fnmatch(name, part)
+                        and (part.startswith('.') or not name.startswith('.'))
+                    )
+                elif part in names:
+                    matches.append(join(path, part))
+            paths = matches
+
+        return paths
+
+    def _listdir(self, path, visited, changed_directories):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return []
+
+        visited.add(path)
+        entry = self.directories.get(path)
+        if entry is None or entry['mtime'] != mtime:
+            try:
+                names = sorted(os.listdir(path))
+            except OSError:
+                return []
+            entry = {'mtime': mtime, 'names': names}
+            self.directories[path] = entry
+            changed_directories.add(path)
+        return entry['names']
+
+    def get(self, image_id):
+        """Get the information about the files of an image"""
+        return self.images.get(image_id)
+
+    def get_file(self, path):
+        """Get the information about an image file (size, mtime, bands and
+        shape) or None if the file is unknown"""
+        return self.files.get(path)
+
+    def stats(self):
+        return {
+            'images': len(self.images),
+            'directories': len(self.directories),
+            'scans': self.scans,
+            'last_scan': self.last_scan,
+        }
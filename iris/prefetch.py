@@ -0,0 +1,164 @@
+"""Render the images a user is going to see next in the background
+
+When a user opens an image, the images they will most likely request next
+(the next and the previous one in their personal order) are rendered in a
+small thread pool and put into the view cache. Prefetching must never slow
+down live requests: the number of concurrent prefetches is capped and a
+prefetch waits as long as live requests are being rendered.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+
+from iris.project import project
+
+
+class Prefetcher:
+    """Background worker pool which warms the caches for upcoming images"""
+    def __init__(self):
+        self.enabled = False
+        self.executor = None
+        self.slots = None
+        self.pending = set()
+        self.live_requests = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.submitted = 0
+        self.completed = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def init(self, config):
+        """Start the worker pool
+
+        Args:
+            config: The prefetch section of the project config.
+        """
+        self.enabled = bool(config['enabled']) and config['workers'] > 0
+        if not self.enabled:
+            return
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=config['workers'], thread_name_prefix='prefetch'
+        )
+        # Prefetches beyond this limit are dropped instead of queued, they
+        # would be outdated anyway once they were processed:
+        self.slots = threading.BoundedSemaphore(config['workers'])
+
+    @contextmanager
+    def live_request(self):
+        """Mark a live request so that prefetches wait until it is done"""
+        with self.lock:
+            self.live_requests += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.live_requests -= 1
+                if not self.live_requests:
+                    self.idle.notify_all()
+
+    def prefetch(self, *image_ids):
+        """Render the given images in the background (if not yet cached)"""
+        if not self.enabled:
+            return
+
+        for image_id in image_ids:
+            with self.lock:
+                if image_id in self.pending:
+                    continue
+                if not self.slots.acquire(blocking=False):
+                    self.skipped += 1
+                    continue
+                self.pending.add(image_id)
+                self.submitted += 1
+            self.executor.submit(self._run, image_id)
+
+    def prefetch_neighbours(self, app, image_id, user_id):
+        """Render the next and the previous image of a user in the background
+
+        Finding the next image can be expensive (see
+        `Project.peek_next_image`), so it is done in the worker pool as well
+        instead of delaying the response.
+
+        Args:
+            app: The flask app (to access the database).
+            image_id: Id of the current image.
+            user_id: Id of the user.
+        """
+        if not self.enabled:
+            return
+        self.executor.submit(self._run_neighbours, app, image_id, user_id)
+
+    def _run_neighbours(self, app, image_id, user_id):
+        # Avoid circular imports since iris.models needs the loaded app:
+        from iris.models import User
+
+        try:
+            with app.app_context():
+                user = User.query.get(user_id)
+                if user is None:
+                    return
+                self.prefetch(
+                    project.peek_next_image(image_id, user),
+                    project.peek_previous_image(image_id, user)
+                )
+        except Exception as error:
+            self.failed += 1
+            print(
+                f'[PREFETCH] Could not find the images next to {image_id}: '
+                f'{error}'
+            )
+
+    def _run(self, image_id):
+        try:
+            self._wait_for_idle()
+            prefetch_image(image_id)
+            self.completed += 1
+        except Exception as error:
+            self.failed += 1
+            print(f'[PREFETCH] Could not prefetch {image_id}: {error}')
+        finally:
+            with self.lock:
+                self.pending.discard(image_id)
+            self.slots.release()
+
+    def _wait_for_idle(self, timeout=10):
+        with self.lock:
+            deadline = time.time() + timeout
+            while self.live_requests and time.time() < deadline:
+                self.idle.wait(deadline - time.time())
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'pending': len(self.pending),
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'skipped': self.skipped,
+            'failed': self.failed,
+        }
+
+
+def prefetch_image(image_id):
+    """Put all views, the thumbnail and the metadata of an image into the
+    caches"""
+    # Avoid circular imports since iris.main needs the loaded app:
+    from iris.main import (
+        get_thumbnail_image, get_tile_image, get_views_images
+    )
+
+    views = [view for view in project['views'].values() if 'data' in view]
+    if project['images']['tiles']:
+        for view in views:
+            get_tile_image(image_id, view, 0, 0, 0)
+    else:
+        get_views_images(image_id, views)
+
+    get_thumbnail_image(image_id)
+    project.get_metadata(image_id)
+
+
+prefetcher = Prefetcher()
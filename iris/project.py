@@ -1,38 +1,108 @@
 """Take care of holding the current project's configurations
 
 """
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import deepcopy
-from glob import glob
+from math import ceil, log2
 from numbers import Number
+import operator
 import os
 from os.path import basename, dirname, exists, getmtime, isabs, join, normpath
-from pprint import pprint
-import re
+import threading
+import time
+import warnings
 
 import flask
 import markupsafe
 
 import json
-from matplotlib import cm
+import matplotlib
 import numpy as np
 from skimage.io import imread
-from skimage.filters import sobel
-from skimage.segmentation import felzenszwalb
 import yaml
 import rasterio as rio
-
-from iris.utils import merge_deep_dicts
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from iris.bands import LazyBands
+from iris.cache import (
+    BakedStore, BandStatsStore, DatasetPool, FeatureStore, IngestedStore,
+    LRUCache, MetadataIndex, RenderCache, SessionCache, hash_key
+)
+from iris.expressions import ExpressionCompiler, RenderEnvironment
+from iris.manifest import Manifest
+from iris.utils import get_peak_rss, merge_deep_dicts, resize_image
+
+# Plain images (e.g. PNGs) are read with rasterio as well and do not need any
+# geo-reference:
+warnings.filterwarnings('ignore', category=rio.errors.NotGeoreferencedWarning)
+
+# Operators to filter images by their metadata (see Project.query_metadata):
+METADATA_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
 
 class Project:
     def __init__(self):
         # Each user is going to get a personalised random sequence of images:
-        self.random_state = np.random.RandomState(seed=0)
         self.image_order = None
         self.image_ids = None
+        # The same ids as set, to look them up in constant time:
+        self.image_id_set = frozenset()
+        self.image_seed = 0
+        # Number of images at startup, images found by later rescans are
+        # appended to the order of each user:
+        self.shuffled_count = 0
+        self.images_lock = threading.RLock()
+        # Number of actions per image and user (see `get_action_counts`):
+        self.action_counts = None
+        self.manifest = None
         self.file = None
         self.debug = False
+        self.view_cache = None
+        self.render_hash = None
+        self.baked = None
+        self.band_stats = None
+        self.ingested = None
+        self.band_cache = LRUCache(0, sizeof=lambda array: array.nbytes)
+        self.datasets = DatasetPool(max_open=0)
+        self.io_executor = None
+        # Band limits of views for consistent stretching of map tiles:
+        self.limits_cache = LRUCache(1024, sizeof=lambda limits: 1)
+        self.metadata_index = None
+        self.features = None
+        self.model_sessions = SessionCache(0, 0)
+        # Overview files for fast zoomed-out map tiles:
+        self.overview_files = {}
+        self.overviews_lock = threading.Lock()
+        self.expressions = {}
+        self.shared_expressions = {}
+        self.colour_maps = {}
+        self.thumbnail_view = None
+        self.render_stats = {
+            'renders': 0,
+            'seconds': 0.,
+            'peak_rss': None,
+            'max_peak_rss_increase': 0,
+        }
+        self.render_stats_lock = threading.Lock()
 
-    def load_from(self, filename):
+    def load_from(self, filename, rescan=True):
+        """Load a project file
+
+        Args:
+            filename: Path to the project file (JSON or YAML).
+            rescan: If False, the manifest is only scanned if it does not
+                exist yet and never rescanned in the background (e.g. in the
+                worker processes, where the server rescans already).
+        """
         if not isabs(filename):
             filename = join(os.getcwd(), filename)
         self.file = filename
@@ -59,7 +129,7 @@ class Project:
         if 'name' not in self.config:
             self.config['name'] = ".".join(basename(filename).split(".")[:-1])
 
-        self._init_paths_and_files(filename)
+        self._init_paths_and_files(filename, rescan)
 
         # Default seed
         self.set_image_seed(0)
@@ -94,6 +164,13 @@ class Project:
             if self['segmentation']['score'] not in ['f1', 'jaccard', 'accuracy']:
                 raise Exception('Unknown segmentation score!', self['segmentation']['score'])
 
+            train_ratio = self['segmentation']['ai_model']['train_ratio']
+            if not 0 < train_ratio <= 1:
+                raise Exception(
+                    '[CONFIG] segmentation:ai_model:train_ratio must be in '
+                    '(0, 1]!'
+                )
+
         # Make sure the HTML is understood in the descriptions:
         for name, view in self.config['views'].items():
             view['name'] = name
@@ -106,6 +183,10 @@ class Project:
                 view['data'] = [view['data']]
                 view['cmap'] = view.get('cmap', 'jet')
 
+        self._compile_expressions()
+        self._init_colour_maps()
+        self._init_thumbnail_view()
+
         self._normalise_classes(self.config)
         for mode in ['segmentation', 'classification', 'detection']:
             if mode in self.config:
@@ -118,6 +199,9 @@ class Project:
         if "debug" not in self.config:
             self['debug'] = False
 
+        self._init_render_hash()
+        self._init_caches()
+
     def __getitem__(self, key):
         return self.config[key]
 
@@ -131,7 +215,7 @@ class Project:
         for klass in data['classes']:
             klass['css_colour'] = f'rgba({str(klass["colour"])[1:-1]})'
 
-    def _init_paths_and_files(self, filename):
+    def _init_paths_and_files(self, filename, rescan=True):
         if project not in self.config:
             self.config['path'] = join(
                 dirname(filename), self.config['name']+'.iris'
@@ -165,32 +249,190 @@ class Project:
         else:
             image_paths = self['images']['path']
 
-        # We will need to extract the image id by using regex. Compile it here
-        # to get a better perfomance:
-        before, id_str, after = image_paths.partition("{id}")
-        if not id_str:
+        if "{id}" not in image_paths:
             raise Exception('[CONFIG] images:path must contain exactly one placeholder "{id}"!')
-        escaped_path = re.escape(before)
-        escaped_path += "(?P<id>.+)"
-        escaped_path += re.escape(after)
-        regex_images = re.compile(escaped_path)
 
-        images = glob(image_paths.format(id="*"))
+        # The manifest remembers all images so that the image directories do
+        # not have to be globbed on every startup:
+        config = self['images']['manifest']
+        self.manifest = Manifest(
+            join(self['path'], 'manifest.json') if config['enabled'] else None,
+            self['images']['path'], self._read_file_header
+        )
+        if not self.manifest.load() \
+                or rescan and config['rescan'] == 'foreground':
+            self.manifest.scan()
+
+        images = self.manifest.image_ids
         if not images:
             raise Exception(
                 f"[CONFIG] No images found in '{image_paths.format(id='*')}'.\n"
                 "Did you set images:path to a valid, existing path?")
 
-        try:
-            self.image_ids = list(sorted([
-                regex_images.match(image_path).groups()[0]
-                for image_path in images
-            ]))
-        except Exception as error:
-            raise Exception(
-                f'[ERROR] Could not extract id\nfrom path"{image_paths}"\nwith regex "{regex_images}"!'
+        self.image_ids = images
+        self.image_id_set = frozenset(images)
+        self.shuffled_count = len(images)
+
+        if rescan and config['enabled'] and config['rescan'] == 'background':
+            self._start_rescans(config['interval'])
+
+    def _start_rescans(self, interval):
+        """Rescan the image directories periodically in a background thread
+
+        New images show up without restarting the server.
+        """
+        manifest = self.manifest
+
+        def rescan():
+            while self.manifest is manifest:
+                time.sleep(interval)
+                try:
+                    if manifest.scan():
+                        self.add_images(manifest.image_ids)
+                except Exception as error:
+                    print(f'[MANIFEST] Could not rescan images: {error}')
+
+        threading.Thread(target=rescan, name='manifest', daemon=True).start()
+
+    def add_images(self, image_ids):
+        """Add new images (e.g. found by a rescan) to the project
+
+        The new images are appended to the order of the images, so that the
+        order in which the users see the known images does not change. Images
+        which do not exist anymore are kept until the server is restarted.
+        """
+        with self.images_lock:
+            new = [
+                image_id for image_id in image_ids
+                if image_id not in self.image_id_set
+            ]
+            if not new:
+                return
+            start = len(self.image_ids)
+            self.image_ids = self.image_ids + new
+            self.image_order = self.image_order + list(
+                range(start, len(self.image_ids))
             )
+            # Only now the new images can be requested:
+            self.image_id_set = self.image_id_set.union(new)
 
+    def has_image(self, image_id):
+        """Check whether an image belongs to the project"""
+        return image_id in self.image_id_set
+
+    def _compile_expressions(self):
+        if isinstance(self['images']['path'], dict):
+            compiler = ExpressionCompiler(list(self['images']['path']))
+        else:
+            compiler = ExpressionCompiler()
+
+        # Invalid expressions raise an exception here, i.e. at startup:
+        self.expressions = compiler.compile_views(self['views'])
+        self.shared_expressions = compiler.shared
+
+    def _init_colour_maps(self):
+        """Precompute a uint8 lookup table for each single-band view"""
+        self.colour_maps = {}
+        for name, view in self['views'].items():
+            if len(view.get('data', [])) != 1:
+                continue
+            try:
+                cmap = matplotlib.colormaps[view.get('cmap', 'jet')]
+            except KeyError:
+                raise Exception(
+                    f"[CONFIG] Unknown colour map '{view.get('cmap')}' in view "
+                    f"'{name}'!"
+                )
+            # One entry per colour of the colour map plus one for NaNs (the
+            # same as matplotlib does when a colour map is called with floats):
+            lut = np.vstack([cmap(np.arange(cmap.N)), cmap(np.nan)])[:, :3]
+            self.colour_maps[name] = (255*lut).astype('uint8')
+
+    def _init_thumbnail_view(self):
+        """Choose the view from which thumbnails are generated (if there are
+        no thumbnail files)"""
+        name = self['images']['thumbnail_view']
+        if name is None:
+            # The first view of the default group that shows image data:
+            names = self.config.get('view_groups', {}).get('default', [])
+            names = [*names, *self['views']]
+            name = next(
+                (name for name in names if 'data' in self['views'].get(name, {})),
+                None
+            )
+        elif 'data' not in self['views'].get(name, {}):
+            raise Exception(
+                f"[CONFIG] images:thumbnail_view '{name}' must be a view with "
+                "image data!"
+            )
+        self.thumbnail_view = name
+
+    def _init_render_hash(self):
+        """Hash of all options (besides the views) that change the pixels of a
+        rendering, so that cached renderings do not survive changing them"""
+        self.render_hash = hash_key(json.dumps({
+            'render': self['render'],
+            'tiles': self['images']['tiles'],
+            'tile_size': self['images']['tile_size'],
+            'shape': self['images'].get('shape'),
+            'band_stats': [
+                self['cache']['band_stats']['enabled'],
+                self['cache']['band_stats']['approximate_above'],
+            ],
+        }, sort_keys=True, default=str))
+
+    def _init_caches(self):
+        # All cache sizes are given in megabytes in the config:
+        config = self['cache']['views']
+        self.view_cache = RenderCache(
+            config['memory'] * 2**20,
+            directory=join(self['path'], 'cache', 'views') if config['disk'] else None,
+            max_disk_bytes=config['disk_size'] * 2**20,
+        )
+        # Renderings created with `iris bake`:
+        self.baked = BakedStore(join(self['path'], 'baked'))
+        # Parsed metadata files:
+        self.metadata_index = MetadataIndex(
+            join(self['path'], 'metadata_index.json')
+        )
+        # Image files converted with `iris ingest`:
+        self.ingested = IngestedStore(join(self['path'], 'ingested'))
+        # Decoded bands of the image files:
+        self.band_cache = LRUCache(
+            self['cache']['images']['memory'] * 2**20,
+            sizeof=lambda array: array.nbytes
+        )
+        # Shared thread pool to read several image files at once:
+        if self.io_executor is not None:
+            self.io_executor.shutdown(wait=False)
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=self['images']['io_threads'],
+            thread_name_prefix='image-io'
+        )
+        # Open rasterio datasets of the image files:
+        config = self['cache']['datasets']
+        self.datasets.clear()
+        self.datasets = DatasetPool(
+            max_open=config['max_open'], idle_timeout=config['idle_timeout']
+        )
+        # Features of the AI model:
+        config = self['cache']['features']
+        self.features = FeatureStore(
+            config['memory'] * 2**20,
+            directory=join(self['path'], 'features') if config['disk'] else None
+        )
+        # Models of the users for warm starts of the AI:
+        config = self['cache']['models']
+        self.model_sessions = SessionCache(
+            config['max_sessions'], config['ttl']
+        )
+        # Statistics for stretching the bands:
+        config = self['cache']['band_stats']
+        self.band_stats = BandStatsStore(
+            join(self['path'], 'band_stats'),
+            approximate_above=config['approximate_above'],
+            max_images=config['max_images']
+        ) if config['enabled'] else None
 
     def make_absolute(self, path):
         """Make path absolute relatively from project path"""
@@ -212,63 +454,208 @@ class Project:
         return 'path' in self.config.get('segmentation', [])
 
     def get_start_image_id(self):
-        return self.image_ids[self.image_order[0]]
+        with self.images_lock:
+            return self.image_ids[self.image_order[0]]
 
-    def load_image(self, filename, bands=None):
+    def load_image(self, filename, bands=None, window=None, downsample=1,
+                   prefix='', dtype=None):
         """Load image from file
 
+        Nothing is read here. The bands are read from the file when they are
+        accessed for the first time (see `LazyBands`).
+
         Args:
             filename:
             bands: Defines which bands to load from file. Must be a list of
                 names starting with $, e.g. "$B1" or "$Sentinel2.B1"
+            window: Load only a part of the image. Must be a list of
+                [x_min, y_min, x_max, y_max] in pixels (same as
+                segmentation:mask_area).
+            downsample: Integer factor by which the image is reduced in size.
+                Overviews are used if the file has some.
+            prefix: Prefix of the band names in the returned dictionary.
+            dtype: If given, the bands are converted to this data type.
 
         Returns:
-            Returns a dictionary with the band names as keys and band array as
-            value.
+            Returns a dictionary-like object with the band names as keys and
+            band arrays as values.
         """
         # The user uses band identifiers (like 'B1', etc):
-        if bands is not None:
-            bands = list(map(
-                lambda s: int(s.replace("$B", ""))-1,
-                bands
-            ))
+        if bands is None:
+            indices = list(range(self.get_band_count(filename)))
+        else:
+            indices = [int(band.replace("$B", ""))-1 for band in bands]
+
+        return LazyBands(
+            [f"{prefix}B{index+1}" for index in indices], indices,
+            lambda selected: self.read_bands(
+                filename, selected, window, downsample
+            ),
+            batch=bands is not None, dtype=dtype
+        )
+
+    def get_band_count(self, filename):
+        """Get the number of bands of an image file (only reads the header)"""
+        return self.get_file_header(filename)['bands']
+
+    def get_file_header(self, filename):
+        """Get the number of bands and the shape of an image file
+
+        The header is only read if the manifest does not know the file (or
+        the file has been modified since the last scan).
+
+        Returns:
+            Dictionary with the number of "bands" and the "shape" as
+            [width, height].
+        """
+        info = self.manifest and self.manifest.get_file(filename)
+        if info is not None and 'bands' in info \
+                and info['mtime'] == getmtime(filename):
+            return {'bands': info['bands'], 'shape': info['shape']}
+        return self._read_file_header(filename)
+
+    def _read_file_header(self, filename):
+        if self.ingested is not None:
+            meta = self.ingested.get(filename, getmtime(filename))
+            if meta is not None:
+                return {'bands': meta['bands'], 'shape': meta['shape']}
+
+        if filename.lower().endswith('npy'):
+            shape = np.load(filename, mmap_mode='r', allow_pickle=False).shape
+            return {
+                'bands': 1 if len(shape) == 2 else shape[-1],
+                'shape': [shape[1], shape[0]],
+            }
+
+        try:
+            with self.datasets.open(filename) as file:
+                return {'bands': file.count, 'shape': [file.width, file.height]}
+        except rio.errors.RasterioIOError:
+            # Formats which GDAL cannot read:
+            array = imread(filename)
+            return {
+                'bands': 1 if array.ndim == 2 else array.shape[-1],
+                'shape': [array.shape[1], array.shape[0]],
+            }
+
+    def read_bands(self, filename, bands, window=None, downsample=1):
+        """Read bands from an image file
+
+        Decoded bands are kept in the band cache (keyed by the path, band,
+        modification time, window and downsampling factor), so each band is
+        decoded only once for all views, thumbnails and predictions. Files
+        converted with `iris ingest` are memory-mapped instead and bypass the
+        band cache.
+
+        Args:
+            filename: Path to the image file.
+            bands: List of band indices (zero-based).
+            window: See `load_image`.
+            downsample: See `load_image`.
+
+        Returns:
+            List of 2D arrays (read-only), one per band.
+        """
+        mtime = getmtime(filename)
+        meta = self.ingested.get(filename, mtime) if self.ingested else None
+        if meta is not None:
+            return self.ingested.read(filename, meta, bands, window, downsample)
+
+        window_key = None if window is None else tuple(window)
+        keys = [
+            (filename, band, mtime, window_key, downsample) for band in bands
+        ]
+        arrays = [self.band_cache.get(key) for key in keys]
+
+        missing = [i for i, array in enumerate(arrays) if array is None]
+        if missing:
+            read = self._read_bands_from_file(
+                filename, [bands[i] for i in missing], window, downsample
+            )
+            for i, array in zip(missing, read):
+                # Copy bands of pixel-interleaved files so that the cache does
+                # not keep the other bands alive:
+                array = np.ascontiguousarray(array)
+                array.flags.writeable = False
+                arrays[i] = array
+                self.band_cache.put(keys[i], array)
 
+        return arrays
+
+    def _read_bands_from_file(self, filename, bands, window=None, downsample=1):
         if filename.lower().endswith('npy'):
             array = np.load(filename, mmap_mode='r', allow_pickle=False)
-            if bands is not None:
-                array = array[..., bands]
-        elif filename.lower().endswith('vrt'):
-            with rio.open(filename) as file:
-                array = file.read(bands)
-                array = np.moveaxis(array, 0, -1)
-        else:
+            if array.ndim == 2:
+                array = array[:, :, np.newaxis]
+            if window is not None:
+                array = array[window[1]:window[3], window[0]:window[2]]
+            if downsample != 1:
+                array = array[::downsample, ::downsample]
+            return [array[..., band] for band in bands]
+
+        try:
+            with self.datasets.open(filename) as file:
+                width, height = file.width, file.height
+        except rio.errors.RasterioIOError:
+            # Formats which GDAL cannot read have to be decoded completely:
             array = imread(filename)
             if len(array.shape) == 2:
                 array = array[:,:,np.newaxis]
-            if bands is not None:
-                array = array[..., bands]
-
-        if bands is None:
-            bands = list(range(array.shape[-1]))
-
-        data = {
-            f"B{b+1}": array[..., i]
-            for i, b in enumerate(bands)
-        }
-        return data
+            if window is not None:
+                array = array[window[1]:window[3], window[0]:window[2]]
+            if downsample != 1:
+                array = array[::downsample, ::downsample]
+            return [array[..., band] for band in bands]
+
+        # Rasterio (GDAL) can read single bands and windows and use overviews
+        # without loading the whole file:
+        if window is None:
+            window = [0, 0, width, height]
+        width, height = window[2] - window[0], window[3] - window[1]
+        out_shape = (ceil(height / downsample), ceil(width / downsample))
+
+        overview_file = None
+        if downsample > 1:
+            overview_file = self.get_overview_file(filename)
+        if overview_file is not None:
+            # The overview file has half of the original resolution:
+            filename = overview_file
+            window = [
+                window[0] // 2, window[1] // 2,
+                ceil(window[2] / 2), ceil(window[3] / 2)
+            ]
+            width, height = window[2] - window[0], window[3] - window[1]
+
+        with self.datasets.open(filename) as file:
+            array = file.read(
+                [b+1 for b in bands],
+                window=Window(window[0], window[1], width, height),
+                out_shape=(len(bands), *out_shape),
+            )
+        return list(array)
 
-    def get_image(self, image_id, bands=None):
+    def get_image(self, image_id, bands=None, window=None, downsample=1,
+                  dtype=None, halo=0):
         """Get the image data as dictionary
 
         Args:
             image_id: Id of the image as string.
             bands: Bands of the image file (or files) to select, e.g. "$B1" or
                 "$Sentinel2.B1".
+            window: Load only a part of the image (see `load_image`).
+            downsample: Integer factor by which the image is reduced in size.
+            dtype: If given, the bands are converted to this data type.
+            halo: Number of pixels by which the window is extended on each side
+                (as far as the image reaches), e.g. so that filters are also
+                correct at the border of the window. Use `expand_window` to
+                get the position of the window within the returned bands.
 
         Returns:
             A dict with bands. The keys are either "$B1"..."$Bn" or
             "$FileIdentifier.B1".
         """
+        if halo:
+            window, _ = self.expand_window(window, halo)
 
         if isinstance(self['images']['path'], dict):
             data = {}
@@ -285,28 +672,57 @@ class Project:
                         continue
 
                 image = self.load_image(
-                    filename.format(id=image_id), bands=file_bands
+                    filename.format(id=image_id), bands=file_bands,
+                    window=window, downsample=downsample, dtype=dtype
                 )
                 data[file_id] = image
+
+            if bands is not None and len(data) > 1:
+                # The selected bands are needed anyway. Read the files
+                # concurrently, so we only have to wait for the slowest one:
+                list(self.io_executor.map(LazyBands.load, data.values()))
         else:
             data = self.load_image(
                 self['images']['path'].format(id=image_id),
-                bands=bands
+                bands=bands, window=window, downsample=downsample,
+                prefix='$', dtype=dtype
             )
-            data = {
-                '$'+key: value
-                for key, value in data.items()
-            }
 
         return data
 
+    def expand_window(self, window, halo):
+        """Extend a window by a halo on each side (as far as the image reaches)
+
+        Args:
+            window: [x_min, y_min, x_max, y_max] in pixels or None for the
+                whole image.
+            halo: Number of pixels.
+
+        Returns:
+            The extended window and a tuple of slices (rows and columns) which
+            select the original window from the extended one.
+        """
+        width, height = self['images']['shape']
+        if window is None:
+            window = [0, 0, width, height]
+
+        extended = [
+            max(window[0] - halo, 0), max(window[1] - halo, 0),
+            min(window[2] + halo, width), min(window[3] + halo, height),
+        ]
+        inner = (
+            slice(window[1] - extended[1], window[3] - extended[1]),
+            slice(window[0] - extended[0], window[2] - extended[0]),
+        )
+        return extended, inner
+
     def get_image_bands(self, image_id):
-        # TODO: probably we could do this faster:
+        """Get the names of all bands of an image (only reads the headers)"""
         image = self.get_image(image_id)
 
         bands = []
         for band in image.keys():
-            if isinstance(image[band], dict):
+            if isinstance(image[band], Mapping):
                 bands.extend([f'${band}.{subband}' for subband in image[band]])
             else:
                 bands.append(f'{band}')
@@ -321,123 +737,554 @@ class Project:
         else:
             return self['images']['path'].format(id=image_id)
 
-    def render_image(self, image_id, view):
-        # Find all required variables
-        bands = re.findall('(?:\$\w+\.{0,1}\w+)', ";".join(view['data']))
-        image = self.get_image(image_id, bands=bands)
-        environment = self._get_render_environment(image)
+    def get_image_mtimes(self, image_id):
+        """Get the modification times of all source files of an image"""
+        paths = self.get_image_path(image_id)
+        if isinstance(paths, dict):
+            paths = list(paths.values())
+        else:
+            paths = [paths]
 
-        rgb_bands = []
-        for i, expression_raw in enumerate(view['data']):
-            expression = re.sub(r'\$(\w+)\.(\w+)', r'\1["\2"]', expression_raw)
-            expression = re.sub(r'\$(\w+)', r'\1', expression)
-            try:
-                # Since one should never rely on evaluating an expression from
-                # untrusted sources, we will have to find a different solution
-                # to make it safe.
-                self._check_band_expression(expression)
-                rgb_bands.append(
-                    eval(expression, {"__builtins__": None}, environment)
+        return tuple(getmtime(path) for path in paths)
+
+    def get_view_mtime(self, image_id):
+        """Get the latest modification time of anything a rendered view depends
+        on (the image files and the project file with the view definitions)"""
+        return max(self.get_image_mtimes(image_id) + (getmtime(self.file),))
+
+    def get_view_hash(self, view):
+        """Hash of the view definition, changes whenever the view is edited"""
+        return hash_key(json.dumps(view, sort_keys=True, default=str))
+
+    def get_view_key(self, image_id, view):
+        """Key which identifies a rendering of a view for an image"""
+        return (
+            image_id, view['name'], self.get_view_hash(view),
+            self.render_hash, self.get_image_mtimes(image_id)
+        )
+
+    def render_image(self, image_id, view, window=None, downsample=1,
+                     limits=None):
+        """Render a view of an image to an RGB array
+
+        Args:
+            image_id: Id of the image as string.
+            view: View dictionary from the project config.
+            window: Render only a part of the image (see `load_image`).
+            downsample: Integer factor by which the image is reduced in size.
+            limits: List with one (lower, upper) tuple per band to stretch the
+                bands between 0 and 1. If None, they are calculated from the
+                rendered data.
+
+        Returns:
+            uint8 array with the shape HxWx3.
+        """
+        with self.measure_render():
+            bands = self.evaluate_view(image_id, view, window, downsample)
+            if limits is None:
+                if window is None:
+                    limits = self.get_band_limits(
+                        view, bands, image_id, downsample
+                    )
+                else:
+                    limits = self.get_band_limits(view, bands)
+            return self.colourise_bands(view, bands, limits)
+
+    def render_views(self, image_id, views):
+        """Render several views of an image at once
+
+        The union of the bands required by all views is loaded only once and
+        all views are evaluated in the same environment, i.e. subexpressions
+        shared between the views are computed only once.
+
+        Returns:
+            A dictionary with the view names as keys and uint8 arrays with the
+            shape HxWx3 as values.
+        """
+        with self.measure_render():
+            environment = self.get_render_environment(
+                image_id, self.get_view_bands(views)
+            )
+
+            rendered = {}
+            for view in views:
+                bands = self.evaluate_view(
+                    image_id, view, environment=environment
                 )
-            except Exception as error:
-                print(
-                    f"Could not parse {i}th expression of {view['name']}\n",
-                    f"Raw expression: {expression_raw}\n",
-                    f"Python expression: {expression}\n",
-                    f"Error: {error}\n",
-                    "Environment:"
+                rendered[view['name']] = self.colourise_bands(
+                    view, bands, self.get_band_limits(view, bands, image_id)
                 )
-                pprint(environment)
+            return rendered
+
+    @contextmanager
+    def measure_render(self):
+        """Measure the time and the peak memory usage of a rendering
+
+        The peak resident set size (RSS) is the high-water mark of the whole
+        process. If a rendering raises it, the increase is an upper bound of
+        the memory required by this rendering. The largest increase helps to
+        size the workers.
+        """
+        peak_before = get_peak_rss()
+        start = time.time()
+        try:
+            yield
+        finally:
+            peak = get_peak_rss()
+            with self.render_stats_lock:
+                stats = self.render_stats
+                stats['renders'] += 1
+                stats['seconds'] += time.time() - start
+                stats['peak_rss'] = peak
+                if peak is not None:
+                    stats['max_peak_rss_increase'] = max(
+                        stats['max_peak_rss_increase'], peak - peak_before
+                    )
+
+    def get_view_bands(self, views):
+        """Get all bands which are required to render the views"""
+        bands = []
+        for view in views:
+            for expression in self.expressions[view['name']]:
+                bands.extend(b for b in expression.bands if b not in bands)
+        return bands
+
+    def get_render_environment(self, image_id, bands, window=None,
+                               downsample=1):
+        """Load the bands and create the namespace for the band expressions"""
+        image = self.get_image(
+            image_id, bands=bands, window=window, downsample=downsample,
+            # All expressions are evaluated in float32 if the bands are:
+            dtype=np.float32 if self['render']['low_memory'] else None
+        )
+        return RenderEnvironment(image, shared=self.shared_expressions)
+
+    def evaluate_view(self, image_id, view, window=None, downsample=1,
+                      environment=None):
+        """Evaluate the band expressions of a view
+
+        Args:
+            environment: Environment from `get_render_environment` with all
+                bands required by the view. If None, a new one is created.
+
+        Returns:
+            A list of 2D arrays, one per band expression of the view.
+        """
+        expressions = self.expressions[view['name']]
+
+        if environment is None:
+            environment = self.get_render_environment(
+                image_id, self.get_view_bands([view]), window, downsample
+            )
+
+        width, height = self['images']['shape']
+        if window is not None:
+            width, height = window[2] - window[0], window[3] - window[1]
+        shape = (ceil(height / downsample), ceil(width / downsample))
+
+        if self['render']['low_memory']:
+            return [
+                self._evaluate_expression_in_chunks(
+                    expression, environment, shape
+                )
+                for expression in expressions
+            ]
+
+        rgb_bands = [
+            expression.evaluate(environment)
+            for expression in expressions
+        ]
 
         # Broadcast (single numbers are converted to an array with the size of
         # image)
-        image_size = project['images']['shape'][0] * project['images']['shape'][1]
         for i, band in enumerate(rgb_bands):
             if isinstance(band, Number):
-                band = np.repeat(band, image_size)
-                band = band.reshape(*project['images']['shape'])
+                band = np.full(shape, band)
 
             rgb_bands[i] = band
 
-        # Stretch between 0->1, with percentile clip if specified in view
+        return rgb_bands
+
+    def _evaluate_expression_in_chunks(self, expression, environment, shape):
+        """Evaluate an expression in float32 to a preallocated band
+
+        Expressions which work pixel by pixel are evaluated in chunks of rows,
+        so that their temporary arrays are only as large as a chunk. Scalars
+        are broadcast without allocating a full band.
+        """
+        if not expression.bands or not expression.elementwise:
+            band = expression.evaluate(environment)
+            if np.ndim(band) == 0:
+                return np.broadcast_to(np.float32(band), shape)
+            return band.astype(np.float32, copy=False)
+
+        band = np.empty(shape, dtype=np.float32)
+        for rows in self._row_chunks(shape[0]):
+            band[rows] = expression.evaluate(
+                environment.rows(rows.start, rows.stop)
+            )
+        return band
+
+    def _row_chunks(self, height):
+        """Split the rows of an image into chunks (slices)
+
+        Without the low-memory render mode, all rows are in one chunk.
+        """
+        if self['render']['low_memory']:
+            chunk_rows = max(1, self['render']['chunk_rows'])
+        else:
+            chunk_rows = max(1, height)
+
+        for start in range(0, height, chunk_rows):
+            yield slice(start, min(start + chunk_rows, height))
+
+    def get_band_limits(self, view, bands, image_id=None, downsample=1):
+        """Get the values which are stretched to 0 and 1 for each band
+
+        Args:
+            view: View dictionary from the project config.
+            bands: List of evaluated bands of the view.
+            image_id: If given, the limits are looked up in (or added to) the
+                band statistics of this image. The bands must cover the whole
+                image then.
+            downsample: Factor by which the bands were reduced in size.
+        """
         if 'clip' in view:
             if 'vmin' in view or 'vmax' in view:
                 raise ValueError("Cannot specify both 'clip' and 'vmin'/'vmax' in view")
             clip = float(view['clip'])
-            linear_scale = lambda z: np.clip(
-                (z - np.percentile(z,clip))/(np.percentile(z,100-clip)-np.percentile(z,clip)),
-                0,
-                1
-                )
-        elif 'vmin' in view or 'vmax' in view:
-            if 'vmin' in view and 'vmax' in view:
-                linear_scale = lambda z: np.clip((z - view['vmin'])/(view['vmax']-view['vmin']), 0, 1)
-            elif 'vmin' in view:
-                linear_scale = lambda z: np.clip((z - view['vmin'])/(z.max()-view['vmin']), 0, 1)
-            elif 'vmax' in view:
-                linear_scale = lambda z: np.clip((z - z.min())/(view['vmax']-z.min()), 0, 1)
+            percentiles = [clip, 100-clip]
         else:
-            linear_scale = lambda z: (z - z.min())/(z.max()-z.min())
-        rgb_bands = list(map(linear_scale, rgb_bands))
-
-        if len(rgb_bands) == 1:
-            rgb_bands = cm.get_cmap(view['cmap'])(rgb_bands)[..., :3]
-
-        rgb_bands = np.dstack(rgb_bands)
-        return (255*rgb_bands).astype('uint8')
-
-    def _get_render_environment(self, image):
-        return {
-            'max': np.max,
-            'max': np.min,
-            'mean': np.mean,
-            'median': np.median,
-            'log': np.log,
-            'exp': np.exp,
-            'sin': np.sin,
-            'cos': np.cos,
-            'PI': np.pi,
-            'edges': sobel,
-            'superpixels': felzenszwalb,
-            **{
-                key.strip('$'): value
-                for key, value in image.items()
-            },
-        }
+            percentiles = []
+
+        if image_id is None or self.band_stats is None \
+                or ('vmin' in view and 'vmax' in view):
+            if percentiles:
+                return [
+                    tuple(np.percentile(band, percentiles)) for band in bands
+                ]
+            return [
+                (view.get('vmin', band.min()), view.get('vmax', band.max()))
+                for band in bands
+            ]
+
+        mtimes = self.get_image_mtimes(image_id)
+        stats = [
+            self.band_stats.get(
+                image_id, mtimes, (source, downsample), band, percentiles
+            )
+            for source, band in zip(view['data'], bands)
+        ]
+        # Save the statistics of all bands at once:
+        self.band_stats.save(image_id)
+
+        if percentiles:
+            return [
+                (band['percentiles'][clip], band['percentiles'][100-clip])
+                for band in stats
+            ]
+
+        return [
+            (view.get('vmin', band['min']), view.get('vmax', band['max']))
+            for band in stats
+        ]
+
+    def colourise_bands(self, view, bands, limits):
+        """Stretch the bands between 0 and 1 and convert them to uint8 RGB"""
+        if self['render']['low_memory']:
+            limits = [
+                (np.float32(lower), np.float32(upper))
+                for lower, upper in limits
+            ]
+
+        if len(bands) == 1:
+            lower, upper = limits[0]
+            lut = self.colour_maps[view['name']]
+            colours = len(lut) - 1
+            rgb = np.empty((*bands[0].shape, 3), dtype='uint8')
+            for rows in self._row_chunks(bands[0].shape[0]):
+                # Quantise the band to the entries of the lookup table:
+                band = np.clip(
+                    (bands[0][rows] - lower)/(upper - lower), 0, 1
+                ) * colours
+                indices = np.minimum(band, colours - 1, out=band).astype(np.intp)
+                indices[np.isnan(band)] = colours
+                rgb[rows] = lut.take(indices, axis=0)
+            return rgb
+
+        rgb = np.empty((*bands[0].shape, len(bands)), dtype='uint8')
+        for i, (band, (lower, upper)) in enumerate(zip(bands, limits)):
+            for rows in self._row_chunks(band.shape[0]):
+                rgb[rows, :, i] = 255*np.clip(
+                    (band[rows] - lower)/(upper - lower), 0, 1
+                )
+        return rgb
 
-    def _check_band_expression(self, expression):
-        forbidden_tokens = ['lambda', '__', 'except', 'eval', ';']
+    def get_max_zoom(self):
+        """Get the zoom level of map tiles at full resolution
 
-        for forbidden in forbidden_tokens:
-            if forbidden in expression:
-                raise Exception(
-                    f"'{forbidden}' is not allowed in band expressions!\n"
-                    + f"Expression: {expression}"
+        At zoom level 0, the whole image fits into one tile.
+        """
+        tile_size = self['images']['tile_size']
+        return max(0, ceil(log2(max(self['images']['shape']) / tile_size)))
+
+    def get_tile_window(self, z, x, y):
+        """Get the window and downsample factor of a map tile
+
+        Returns:
+            A tuple of the window ([x_min, y_min, x_max, y_max] in image
+            pixels) and the downsample factor. If the tile is outside of the
+            image, (None, None) is returned.
+        """
+        width, height = self['images']['shape']
+        max_zoom = self.get_max_zoom()
+        if not 0 <= z <= max_zoom:
+            return None, None
+
+        downsample = 2 ** (max_zoom - z)
+        span = self['images']['tile_size'] * downsample
+        x_min, y_min = x * span, y * span
+        if x < 0 or y < 0 or x_min >= width or y_min >= height:
+            return None, None
+
+        window = [
+            x_min, y_min, min(x_min + span, width), min(y_min + span, height)
+        ]
+        return window, downsample
+
+    def get_view_limits(self, image_id, view):
+        """Get the band limits of a view for the whole image
+
+        Map tiles only see a small part of the image. To get consistent colours
+        between the tiles, the limits are calculated once from the overview of
+        the image (zoom level 0) and then reused for all tiles.
+        """
+        key = self.get_view_key(image_id, view)
+        limits = self.limits_cache.get(key)
+        if limits is None:
+            window, downsample = self.get_tile_window(0, 0, 0)
+            bands = self.evaluate_view(image_id, view, downsample=downsample)
+            limits = self.get_band_limits(view, bands, image_id, downsample)
+            self.limits_cache.put(key, limits)
+        return limits
+
+    def render_tile(self, image_id, view, z, x, y):
+        """Render a map tile of a view
+
+        Returns:
+            uint8 array with the shape HxWx3 or None if the tile is outside
+            of the image.
+        """
+        window, downsample = self.get_tile_window(z, x, y)
+        if window is None:
+            return None
+
+        return self.render_image(
+            image_id, view, window=window, downsample=downsample,
+            limits=self.get_view_limits(image_id, view)
+        )
+
+    def get_overview_file(self, filename):
+        """Get a file with overviews of an image file
+
+        Reading zoomed-out map tiles from the full resolution would read the
+        whole image file. Hence, we store the image at half of its resolution
+        with an internal pyramid of further overviews in the project directory.
+        It is built when it is needed for the first time or when the image
+        file has changed.
+
+        Returns:
+            The path to the overview file or None if the image is small or has
+            overviews already.
+        """
+        mtime = getmtime(filename)
+        with self.overviews_lock:
+            if filename in self.overview_files \
+                    and self.overview_files[filename][0] == mtime:
+                return self.overview_files[filename][1]
+
+            overview_file = join(
+                self['path'], 'overviews', hash_key(filename) + '.tif'
+            )
+            with rio.open(filename) as file:
+                tile_size = self['images']['tile_size']
+                if file.overviews(1) \
+                        or max(file.width, file.height) < 2*tile_size:
+                    overview_file = None
+                elif not exists(overview_file) \
+                        or getmtime(overview_file) < mtime:
+                    self._build_overview_file(file, overview_file)
+
+            self.overview_files[filename] = (mtime, overview_file)
+            return overview_file
+
+    def _build_overview_file(self, file, overview_file):
+        print(f'Building overviews for {file.name}...')
+        os.makedirs(dirname(overview_file), exist_ok=True)
+        width, height = ceil(file.width / 2), ceil(file.height / 2)
+        factors = []
+        factor = 2
+        while max(width, height) / factor >= self['images']['tile_size']:
+            factors.append(factor)
+            factor *= 2
+
+        temp_file = overview_file + '.tmp'
+        with rio.open(
+                temp_file, 'w', driver='GTiff', width=width, height=height,
+                count=file.count, dtype=file.dtypes[0], tiled=True,
+                blockxsize=256, blockysize=256) as overview:
+            # Band by band to keep the memory footprint small:
+            for index in file.indexes:
+                overview.write(
+                    file.read(
+                        index, out_shape=(height, width),
+                        resampling=Resampling.average
+                    ),
+                    index
                 )
+            if factors:
+                overview.build_overviews(factors, Resampling.average)
+        os.replace(temp_file, overview_file)
 
     def get_metadata(self, image_id):
-        filename = self['images'].get('metadata', False)
-        if not filename:
+        """Get the metadata of an image (from the metadata index if the file
+        has not changed since it was indexed)"""
+        key = self.get_metadata_key(image_id)
+        if key is None:
             return {}
 
-        filename = filename.format(id=image_id)
+        return self.metadata_index.get(
+            image_id, *key, self._parse_metadata_file
+        )
 
+    def _parse_metadata_file(self, filename):
         with open(filename, 'r') as stream:
             if filename.endswith('json'):
-                metadata = json.load(stream)
+                return json.load(stream)
             elif filename.endswith('yaml'):
-                metadata = yaml.safe_load(stream)
+                return yaml.safe_load(stream)
             else:
                 return {"__body__": stream.read()}
 
-        return metadata
+    def query_metadata(self, image_ids=None, filters=(), sort=None):
+        """Get the metadata of many images, filtered and sorted by fields
+
+        Args:
+            image_ids: List of image ids. Defaults to all images.
+            filters: List of (field, operator, value) tuples. Fields of nested
+                dictionaries and lists are separated by dots (e.g.
+                "location.0"). Operators are ==, !=, <, <=, > and >=. Images
+                without the field or with an incomparable value are excluded.
+                Images without metadata file have empty metadata.
+            sort: Field by which the images are sorted. Prefix it with "-" to
+                sort in descending order. Images without the field come last.
+
+        Returns:
+            List of (image_id, metadata) tuples.
+        """
+        if image_ids is None:
+            image_ids = self.image_ids
+
+        images = []
+        for image_id in image_ids:
+            try:
+                metadata = self.get_metadata(image_id)
+            except OSError:
+                # An image without metadata file must not fail the others:
+                metadata = {}
+            try:
+                if all(
+                        METADATA_OPERATORS[op](
+                            get_metadata_field(metadata, field), value
+                        )
+                        for field, op, value in filters):
+                    images.append((image_id, metadata))
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+        self.metadata_index.save()
+
+        if sort:
+            descending = sort.startswith('-')
+            field = sort.lstrip('-')
+            values = {}
+            for image_id, metadata in images:
+                try:
+                    values[image_id] = get_metadata_field(metadata, field)
+                except (KeyError, IndexError, TypeError, ValueError):
+                    pass
+            missing = [image for image in images if image[0] not in values]
+            images = [image for image in images if image[0] in values]
+            try:
+                images.sort(
+                    key=lambda image: values[image[0]], reverse=descending
+                )
+            except TypeError:
+                # Values of different types, e.g. numbers and strings:
+                images.sort(
+                    key=lambda image: str(values[image[0]]),
+                    reverse=descending
+                )
+            images += missing
+
+        return images
+
+    def get_metadata_key(self, image_id):
+        """Key which identifies the metadata of an image (filename and
+        modification time) or None if the project has no metadata"""
+        filename = self['images'].get('metadata', False)
+        if not filename:
+            return None
+
+        filename = filename.format(id=image_id)
+        return (filename, getmtime(filename))
+
+    def get_thumbnail_key(self, image_id):
+        """Key which identifies the thumbnail of an image
+
+        The third element is always the modification time of the thumbnail.
+        """
+        filename = self['images'].get('thumbnails', False)
+        if filename:
+            return (
+                image_id, 'thumbnail', getmtime(filename.format(id=image_id))
+            )
+
+        if self.thumbnail_view is None:
+            return None
+        view = self['views'][self.thumbnail_view]
+        return (
+            image_id, 'thumbnail', self.get_view_mtime(image_id),
+            self.get_view_hash(view), self.render_hash,
+            self['images']['thumbnail_size']
+        )
 
     def get_thumbnail(self, image_id):
+        """Get the thumbnail of an image
+
+        If the project has no thumbnail files, the thumbnail is rendered from
+        images:thumbnail_view so that its larger side has the length of
+        images:thumbnail_size.
+
+        Returns:
+            The thumbnail as array or None if the project has neither
+            thumbnail files nor a view to render them.
+        """
         filename = self['images'].get('thumbnails', False)
-        if not filename:
+        if filename:
+            return imread(filename.format(id=image_id))
+
+        if self.thumbnail_view is None:
             return None
 
-        return imread(filename.format(id=image_id))
+        # Downsampling while reading is much cheaper than rendering the full
+        # view and resizing it afterwards:
+        size = self['images']['thumbnail_size']
+        downsample = max(1, max(self['images']['shape']) // size)
+        array = self.render_image(
+            image_id, self['views'][self.thumbnail_view],
+            downsample=downsample
+        )
+        return resize_image(array, fit=size)
 
     def get_user_config(self, user_id):
         filename = join(self['path'], 'user_config', f'{user_id}.json')
@@ -466,67 +1313,136 @@ class Project:
             json.dump(user_config, stream)
 
     def get_next_image(self, image_id, user_id):
-
-        original_index = self.image_ids.index(image_id)
-        index = self.image_order.index(original_index)
-
+        with self.images_lock:
+            index = self.image_order.index(self.image_ids.index(image_id))
+            next_index = self._find_next_index(index, user_id)
+
+            if next_index != (index + 1) % len(self.image_order):
+                # Once a suitable image is found, update the list so that its
+                # next in line (this means self.get_previous_image retains
+                # expected behaviour immediately afterwards).
+                a = next_index
+                b = (index + 1) % len(self.image_order)
+                self.image_ids[self.image_order[a]], self.image_ids[self.image_order[b]] = \
+                    self.image_ids[self.image_order[b]], self.image_ids[self.image_order[a]]
+
+            index = (index + 1) % len(self.image_order)
+            return self.image_ids[self.image_order[index]]
+
+    def peek_next_image(self, image_id, user):
+        """Get the image that get_next_image would return for a user without
+        changing the shared order of the images"""
+        with self.images_lock:
+            image_ids = list(self.image_ids)
+            image_order = self.get_image_order(user.image_seed)
+        index = image_order.index(image_ids.index(image_id))
+        return image_ids[image_order[
+            self._find_next_index(index, user, image_ids, image_order)
+        ]]
+
+    def peek_previous_image(self, image_id, user):
+        """Get the image that get_previous_image would return for a user
+        without changing the shared order of the images"""
+        with self.images_lock:
+            image_ids = list(self.image_ids)
+            image_order = self.get_image_order(user.image_seed)
+        index = image_order.index(image_ids.index(image_id))
+        return image_ids[image_order[(index - 1) % len(image_order)]]
+
+    def _find_next_index(self, index, user_id, image_ids=None,
+                         image_order=None):
+        """Find the position (in self.image_order) of the next image"""
+        image_ids = image_ids or self.image_ids
+        image_order = image_order or self.image_order
         # 'prioritise_unmarked_images' mode will search the database of existing
         # masks, and find images with the lowest number of annotations to serve
-        # when a user asks for the next image. Then it will swap this image
-        # into the existing order to make it come up next.
-        if self.config['segmentation']['prioritise_unmarked_images']:
-            from iris.models import Action
-            actions = Action.query.all()
-            # Same order as self.image_order (NOT self.image_ids)
-            mask_count = [0]*len(self.image_order)
-            mask_count[index] = 99999 # Make sure the current image isn't selected as the new one
-            for action in actions:
-                mask_count[
-                    self.image_order.index(
-                        self.image_ids.index(
-                            action.image_id
-                            )
-                            )
-                            ] += 1
-
-                if user_id.id == action.user_id:
-                    mask_count[
-                        self.image_order.index(
-                            self.image_ids.index(
-                                action.image_id
-                                )
-                                )
-                                ] += 9999
-
-            min_labellers = min(mask_count)
-            # iterate through images until one is found with fewest existing masks
-            next_image_found = False
-            trial_idx = index
-            while not next_image_found:
-                trial_idx = (trial_idx + 1) % len(self.image_order)
-                if mask_count[trial_idx] == min_labellers and trial_idx != index:
-                    # Once a suitable image is found, update the list so that its
-                    # next in line (this means self.get_previous_image retains expected
-                    # behaviour immediately afterwards).
-                    a = trial_idx
-                    b = (index + 1) % len(self.image_order)
-                    self.image_ids[self.image_order[a]], self.image_ids[self.image_order[b]] = \
-                        self.image_ids[self.image_order[b]], self.image_ids[self.image_order[a]]
-                    next_image_found = True
-        index = (index + 1) % len(self.image_order)
-        return self.image_ids[self.image_order[index]]
+        # when a user asks for the next image.
+        if not self.config['segmentation']['prioritise_unmarked_images']:
+            return (index + 1) % len(image_order)
+
+        # Same order as image_order (NOT image_ids)
+        positions = {
+            image_ids[image_index]: position
+            for position, image_index in enumerate(image_order)
+        }
+        mask_count = [0]*len(image_order)
+        mask_count[index] = 99999 # Make sure the current image isn't selected as the new one
+        for image_id, users in self.get_action_counts().items():
+            if image_id not in positions:
+                continue
+            mask_count[positions[image_id]] += sum(users.values())
+            if user_id.id in users:
+                mask_count[positions[image_id]] += 9999 * users[user_id.id]
+
+        min_labellers = min(mask_count)
+        # iterate through images until one is found with fewest existing masks
+        trial_idx = index
+        while True:
+            trial_idx = (trial_idx + 1) % len(image_order)
+            if mask_count[trial_idx] == min_labellers and trial_idx != index:
+                return trial_idx
+
+    def get_action_counts(self):
+        """Get the number of actions per image and user
+
+        The counts are cached until `invalidate_action_counts` is called
+        (i.e. whenever actions are saved).
 
-    def get_previous_image(self, image_id):
-        original_index = self.image_ids.index(image_id);
+        Returns:
+            Dictionary {image_id: {user_id: number of actions}}.
+        """
+        counts = self.action_counts
+        if counts is None:
+            from iris.models import db, Action
+            rows = db.session.query(
+                Action.image_id, Action.user_id, db.func.count(Action.id)
+            ).group_by(Action.image_id, Action.user_id).all()
+            counts = {}
+            for image_id, user_id, count in rows:
+                counts.setdefault(image_id, {})[user_id] = count
+            self.action_counts = counts
+        return counts
+
+    def invalidate_action_counts(self):
+        self.action_counts = None
 
-        index = self.image_order.index(original_index)
-        index = (index - 1) % len(self.image_order)
-        return self.image_ids[self.image_order[index]]
+    def get_previous_image(self, image_id):
+        with self.images_lock:
+            original_index = self.image_ids.index(image_id);
+
+            index = self.image_order.index(original_index)
+            index = (index - 1) % len(self.image_order)
+            return self.image_ids[self.image_order[index]]
+
+    def get_image_order(self, seed):
+        """Get the order of the images for a seed (without changing the
+        shared order)"""
+        with self.images_lock:
+            image_order = list(range(self.shuffled_count))
+            np.random.RandomState(seed=seed).shuffle(image_order)
+            # Images added since the startup come last:
+            return image_order + list(
+                range(self.shuffled_count, len(self.image_ids))
+            )
 
     def set_image_seed(self, seed):
-        self.random_state = np.random.RandomState(seed=seed)
-        self.image_order = list(range(len(self.image_ids)))
-
-        self.random_state.shuffle(self.image_order)
+        with self.images_lock:
+            self.image_seed = seed
+            self.image_order = self.get_image_order(seed)
+
+def get_metadata_field(metadata, field):
+    """Get a (nested) field of metadata, e.g. "location.0"
+
+    Raises:
+        KeyError, IndexError, TypeError or ValueError if the field does not
+        exist.
+    """
+    value = metadata
+    for part in field.split('.'):
+        if isinstance(value, list):
+            value = value[int(part)]
+        else:
+            value = value[part]
+    return value
 
 project = Project()
@@ -1,3 +1,4 @@
+from concurrent.futures import CancelledError
 from datetime import datetime, timedelta
 from glob import glob
 import json
@@ -6,19 +7,18 @@ from os.path import basename, dirname, exists, join
 import time
 from pprint import pprint
 
-import lightgbm as lgb
 import flask
 import numpy as np
-from scipy.ndimage import convolve, minimum_filter, maximum_filter
+from scipy.ndimage import minimum_filter, maximum_filter
 from skimage.io import imread, imsave
-from skimage.filters import sobel
-from skimage.segmentation import felzenszwalb
-from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, f1_score, jaccard_score
 import yaml
 
+from iris.ai import predict
+from iris.jobs import jobs
 from iris.user import requires_auth
 from iris.models import db, User, Action
+from iris.prefetch import prefetcher
 from iris.project import project
 
 segmentation_app = flask.Blueprint(
@@ -44,9 +44,16 @@ def index():
 
             if last_mask is not None:
                 image_id = last_mask.image_id
-    elif image_id not in project.image_ids:
+    elif not project.has_image(image_id):
         return flask.make_response('Unknown image id!', 404)
 
+    user_id = flask.session.get('user_id', None)
+    if user_id:
+        # Render the images the user is going to see next in the background:
+        prefetcher.prefetch_neighbours(
+            flask.current_app._get_current_object(), image_id, user_id
+        )
+
     metadata = project.get_metadata(image_id)
     return flask.render_template(
         'segmentation.html',
@@ -58,12 +65,13 @@ def index():
 @requires_auth
 def next_image():
     user = User.query.get(flask.session['user_id'])
-    project.set_image_seed(user.image_seed)
-
-    image_id = project.get_next_image(
-        flask.request.args.get('image_id', project.get_start_image_id()),
-        user
-    )
+    # The order of the images is shared, so seed and navigate at once:
+    with project.images_lock:
+        project.set_image_seed(user.image_seed)
+        image_id = project.get_next_image(
+            flask.request.args.get('image_id', project.get_start_image_id()),
+            user
+        )
 
     return flask.redirect(
         flask.url_for('segmentation.index', image_id=image_id)
@@ -73,11 +81,12 @@ def next_image():
 @requires_auth
 def previous_image():
     user = User.query.get(flask.session['user_id'])
-    project.set_image_seed(user.image_seed)
-
-    image_id = project.get_previous_image(
-        flask.request.args.get('image_id', project.get_start_image_id())
-    )
+    # The order of the images is shared, so seed and navigate at once:
+    with project.images_lock:
+        project.set_image_seed(user.image_seed)
+        image_id = project.get_previous_image(
+            flask.request.args.get('image_id', project.get_start_image_id())
+        )
 
     return flask.redirect(
         flask.url_for('segmentation.index', image_id=image_id)
@@ -295,119 +304,71 @@ def save_mask(image_id):
     db.session.commit()
 
     merge_masks(image_id)
+    project.invalidate_action_counts()
 
     # We need this to send a successful response to the client
     return flask.make_response('Masks successfully saved!')
 
-def image_dict_to_array(image_dict):
-    if isinstance(image_dict, np.ndarray):
-        return image_dict
-
-    return np.dstack(
-        [image_dict_to_array(v) for v in image_dict.values()]
-    )
 
 @segmentation_app.route('/predict_mask/<image_id>', methods=['POST'])
 @requires_auth
 def predict_mask(image_id):
-    config = project.get_user_config(flask.session['user_id'])
-    config = config['segmentation']
-
-    print('Fit options:', config)
+    """Predict the mask and wait for the result (see `submit_prediction` for
+    the asynchronous version)
 
-    # How to exclude certain bands?
-    image_dict = project.get_image(image_id, bands=config['ai_model']['bands'])
-    image = image_dict_to_array(image_dict)
+    The request waits cooperatively, i.e. other requests are still served in
+    the meantime (see `JobQueue.wait`).
+    """
+    job = submit_prediction_job(image_id)
+    try:
+        return prediction_response(jobs.wait(job))
+    except CancelledError:
+        return flask.make_response('Replaced by a newer prediction!', 409)
 
-    n_channels = image.shape[-1]
+@segmentation_app.route('/predict_mask/<image_id>/submit', methods=['POST'])
+@requires_auth
+def submit_prediction(image_id):
+    """Submit a prediction job, its state can be polled at /jobs/<job_id>"""
+    job = submit_prediction_job(image_id)
+    return flask.make_response(flask.jsonify(job.to_json()), 202)
 
-    # Select only the masking area:
-    mask_area = (
-        slice(config['mask_area'][1], config['mask_area'][3]),
-        slice(config['mask_area'][0], config['mask_area'][2]),
-        slice(None, None, None)
-    )
-    mask_size = config['mask_shape'][0] * config['mask_shape'][1]
-    image = image[mask_area]
+@segmentation_app.route('/jobs/<job_id>', methods=['GET'])
+@requires_auth
+def job_state(job_id):
+    job = jobs.get(job_id, flask.session['user_id'])
+    if job is None:
+        return flask.make_response('Unknown job!', 404)
+    return flask.jsonify(job.to_json())
 
+@segmentation_app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@requires_auth
+def cancel_job(job_id):
+    job = jobs.get(job_id, flask.session['user_id'])
+    if job is None:
+        return flask.make_response('Unknown job!', 404)
+    jobs.cancel(job)
+    return flask.jsonify(job.to_json())
+
+@segmentation_app.route('/jobs/<job_id>/result', methods=['GET'])
+@requires_auth
+def job_result(job_id):
+    job = jobs.get(job_id, flask.session['user_id'])
+    if job is None:
+        return flask.make_response('Unknown job!', 404)
+    if job.state in ['queued', 'running']:
+        return flask.make_response(flask.jsonify(job.to_json()), 202)
+    if job.state != 'done':
+        return flask.make_response(flask.jsonify(job.to_json()), 409)
+    return prediction_response(jobs.result(job, timeout=0))
+
+def submit_prediction_job(image_id):
     data = json.loads(flask.request.data)
-    user_indices = np.array(data['user_pixels'])
-    user_labels = np.array(data['user_labels'])
-
-    inputs = [image]
-    if config['ai_model']['use_edge_filter']:
-        edges = np.dstack([
-            sobel(image[..., i])
-            for i in range(n_channels)
-        ])
-        inputs.append(edges)
-
-    if config['ai_model']['use_meshgrid']:
-        if config['ai_model']['meshgrid_cells'] == "pixelwise":
-            x_size, y_size = image.shape[0], image.shape[1]
-        else:
-            x_size, y_size = map(int, config['ai_model']['meshgrid_cells'].split('x'))
-        y_size = 3
-        x = np.repeat(np.arange(x_size), int(image.shape[0]/x_size)+1)
-        y = np.repeat(np.arange(y_size), int(image.shape[1]/y_size)+1)
-        x_grid, y_grid = np.meshgrid(x[:image.shape[0]], y[:image.shape[1]])
-        inputs.append(x_grid[..., np.newaxis])
-        inputs.append(y_grid[..., np.newaxis])
-
-    if config['ai_model']['use_superpixels']:
-        super_pixels = felzenszwalb(
-            image, scale=image.shape[0]/5, sigma=4, min_size=100
-        )
-        inputs.append(super_pixels)
-
-    inputs = np.dstack(inputs).reshape(mask_size, -1)
-
-    train_indices, val_indices, train_labels, val_labels = train_test_split(
-        user_indices, user_labels, stratify=user_labels,
-        test_size=0.3, random_state=42
-    )
-
-    gbm = lgb.LGBMClassifier(
-        num_leaves=config['ai_model']['n_leaves'],
-        max_bin=128,
-        max_depth=config['ai_model']['max_depth'],
-        # min_data_in_leaf=1000,
-        # bagging_fraction=0.2,
-        # boosting_type='dart',
-        tree_learner='data',
-        learning_rate=0.05,
-        n_estimators=config['ai_model']['n_estimators'],
-        n_jobs=10,
-    )
-    early_stopping = lgb.early_stopping(4, verbose=False)
-    gbm.fit(
-        inputs[train_indices, :], train_labels,
-        eval_set=[(inputs[val_indices, :], val_labels)],
-        callbacks=[early_stopping]
+    return jobs.submit(
+        flask.session['user_id'], image_id, predict, image_id,
+        flask.session['user_id'], data['user_pixels'], data['user_labels']
     )
 
-    # predict the mask for the whole image:
-    predictions = gbm.predict(
-        inputs, num_iteration=gbm.best_iteration_
-    )
-    predictions = predictions.astype(np.uint8)
-
-    # Apply suppression filter:
-    if config['ai_model']['suppression_threshold'] != 0:
-        other_classes = (predictions != config['ai_model']['suppression_default_class']).astype(int)
-        other_classes = other_classes.reshape(*config['mask_shape'])
-        window_size = config['ai_model']['suppression_filter_size']
-        window = np.ones((window_size, window_size))
-        window[window_size//2, window_size//2] = 0
-        neighbourhood_ratio = convolve(
-            other_classes, window, mode='constant', cval=0.5
-        ) / (window_size**2 - 1)
-        suppress = 100 * neighbourhood_ratio.ravel() < config['ai_model']['suppression_threshold']
-        predictions[suppress] = config['ai_model']['suppression_default_class']
-
-    # Return the results:
-    response = flask.make_response(
-        predictions.tobytes()
-    )
+def prediction_response(predictions):
+    response = flask.make_response(predictions)
     response.headers.set('Content-Type', 'application/octet-stream')
     return response
@@ -130,7 +130,10 @@ function init_views(){
         get_object('views-container'),
         vars.config.views, vars.config.view_groups,
         vars.url.main+"image/",
-        image_aspect_ratio=vars.image_shape[0]/vars.image_shape[1]
+        image_aspect_ratio=vars.image_shape[0]/vars.image_shape[1],
+        tile_url=vars.config.images.tiles ? vars.url.main+"tile/" : null,
+        tile_size=vars.config.images.tile_size,
+        views_url=vars.url.main+"views/"
     );
 
     // Add standard layers to all view ports if the view type is not "bingmap":
@@ -1316,6 +1319,36 @@ async function save_mask_finished(response, call_afterwards){
     }
 }
 
+async function run_prediction_job(data){
+    /*Submit a prediction job, wait until it is done and download its result
+
+    Returns:
+        The same as download() or null if the job was replaced or cancelled.
+    */
+    let submitted = await download(
+        vars.url.segmentation+"predict_mask/" + vars.image_id + "/submit",
+        {method: "POST", body: JSON.stringify(data)}
+    );
+    if (submitted.data === null){
+        return submitted;
+    }
+
+    let job = submitted.data;
+    while (job.state == "queued" || job.state == "running"){
+        show_loader(job.state == "queued" ? "Waiting for the AI..." : "Train AI...");
+        await new Promise((resolve) => setTimeout(resolve, 250));
+        let state = await download(vars.url.segmentation+"jobs/"+job.id);
+        if (state.data === null){
+            return state;
+        }
+        job = state.data;
+    }
+    if (job.state == "replaced" || job.state == "cancelled"){
+        return null;
+    }
+    return await download(vars.url.segmentation+"jobs/"+job.id+"/result");
+}
+
 async function predict_mask(){
     var user_classes = [];
     for (var i=0; i < vars.classes.length; i++){
@@ -1390,16 +1423,15 @@ async function predict_mask(){
     }
 
     show_loader("Train AI...");
-    let results = await download(
-            vars.url.segmentation+"predict_mask/" + vars.image_id,
-            {
-                method: "POST",
-                body: JSON.stringify({
-                    "user_pixels": train_user_pixels,
-                    "user_labels": train_user_labels
-                })
-            }
-        );
+    let results = await run_prediction_job({
+        "user_pixels": train_user_pixels,
+        "user_labels": train_user_labels
+    });
+    if (results === null){
+        // Replaced by a newer prediction or cancelled:
+        hide_loader();
+        return;
+    }
 
     show_loader("Process results...");
     if (results.response.status >= 500) {
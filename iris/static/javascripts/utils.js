@@ -233,3 +233,24 @@ function toggle_display(button) {
       panel.style.display = "block";
     }
 }
+
+function unpack_files(buffer){
+    /*Unpack the files of a binary container (see pack_files in iris.main)
+
+    Returns:
+        The header of the container and a dictionary with the file names as
+        keys and Blobs as values.
+    */
+    let header_length = new DataView(buffer).getUint32(0, true);
+    let header = JSON.parse(
+        new TextDecoder().decode(new Uint8Array(buffer, 4, header_length))
+    );
+    let files = {};
+    for (let file of header.files){
+        files[file.name] = new Blob(
+            [new Uint8Array(buffer, 4 + header_length + file.offset, file.length)],
+            {type: file.type}
+        );
+    }
+    return [header, files];
+}
@@ -1,11 +1,17 @@
 class ViewManager{
-    constructor(container, views, view_groups, view_url, image_aspect_ratio=1){
+    constructor(container, views, view_groups, view_url, image_aspect_ratio=1, tile_url=null, tile_size=256, views_url=null){
         this.container = container;
         this.views = views;
         this.ports = [];
         this.view_groups = view_groups;
         this.current_group = 'default';
         this.view_url = view_url;
+        // If tile_url is set, the views are loaded as map tiles:
+        this.tile_url = tile_url;
+        this.tile_size = tile_size;
+        // If views_url is set, all views are loaded with one request:
+        this.views_url = views_url;
+        this.pending_sources = new Set();
         this.image_aspect_ratio = image_aspect_ratio;
         this.image_id = null;
         this.image_location = [0, 0];
@@ -25,7 +31,68 @@ class ViewManager{
         this.clear();
         this.image_id = image_id;
         this.image_location = image_location;
+        if (this.source !== undefined){
+            for (let image of Object.values(this.source)){
+                if (image.src.startsWith("blob:")){
+                    URL.revokeObjectURL(image.src);
+                }
+            }
+        }
         this.source = {};
+        this.pending_sources = new Set();
+    }
+    loadSources(){
+        /*Load the images of all current views with one request*/
+        let names = [];
+        for (let view of this.getCurrentViews()){
+            if (view.type == "image"
+                && !this.source.hasOwnProperty(view.name)
+                && !this.pending_sources.has(view.name)){
+                names.push(view.name);
+            }
+        }
+        if (!names.length){
+            return;
+        }
+
+        let image_id = this.image_id;
+        let query = names.map((name) => "view="+encodeURIComponent(name));
+        for (let name of names){
+            this.pending_sources.add(name);
+        }
+        fetch(this.views_url+image_id+"?"+query.join("&"))
+            .then((response) => {
+                if (!response.ok){
+                    throw new Error(response.statusText);
+                }
+                return response.arrayBuffer();
+            })
+            .then((buffer) => {
+                if (image_id != this.image_id){
+                    // The user moved on to another image already
+                    return;
+                }
+                let [header, files] = unpack_files(buffer);
+                for (let [name, blob] of Object.entries(files)){
+                    let image = new Image();
+                    image.src = URL.createObjectURL(blob);
+                    this.source[name] = image;
+                    this.pending_sources.delete(name);
+                }
+            })
+            .catch((error) => {
+                if (image_id != this.image_id){
+                    // The user moved on to another image already
+                    return;
+                }
+                // Fall back to loading the views one by one:
+                for (let name of names){
+                    let image = new Image();
+                    image.src = this.view_url+image_id+"/"+name;
+                    this.source[name] = image;
+                    this.pending_sources.delete(name);
+                }
+            });
     }
     setImageLocation(location){
         this.image_location = location;
@@ -382,25 +449,114 @@ class RGBLayer extends CanvasLayer{
         if (this.vm.source.hasOwnProperty(this.view.name)){
           return;
         }
+        if (this.vm.views_url !== null){
+            this.vm.loadSources();
+            return;
+        }
 
         this.vm.source[this.view.name] = new Image();
         this.vm.source[this.view.name].src =
             this.vm.view_url+this.vm.image_id+"/"+this.view.name;
         // this.image[name].onload = render_image.bind(null, i, true);
     }
+    loadTile(z, x, y){
+        /*Load a map tile if it was not loaded already*/
+        let tile = z+"/"+x+"/"+y;
+        let key = this.view.name+"/"+tile;
+        if (!this.vm.source.hasOwnProperty(key)){
+            let image = new Image();
+            // Redraw the views as soon as the tile has arrived:
+            image.onload = () => {
+                for (let layer of this.vm.getLayers("rgb")){
+                    layer.render();
+                }
+            };
+            image.src = this.vm.tile_url+this.vm.image_id+"/"+this.view.name+"/"+tile;
+            this.vm.source[key] = image;
+        }
+        return this.vm.source[key];
+    }
     render(){
+        if (this.vm.tile_url !== null){
+            this.renderTiles();
+            return;
+        }
+
         this.loadSource();
 
         // Check whether the image has been loaded already
         let image = this.vm.source[this.view.name];
-        if (!image.complete){
+        if (image === undefined || !image.complete){
             setTimeout(() => {this.render();}, 100);
             return;
         }
 
         let canvas = this.container;
         let ctx = canvas.getContext('2d');
+        this.applyFilters();
+
+        ctx.drawImage(
+            image, 0, 0, image.width, image.height
+        );
+
+        // Set mask visibility based on current vars.show_mask
+        show_mask(vars.show_mask);
+    }
+    renderTiles(){
+        /*Draw only the map tiles which are visible in the canvas*/
+        let canvas = this.container;
+        let ctx = canvas.getContext('2d');
+        let [width, height] = vars.image_shape;
+        let size = this.vm.tile_size;
+        let max_zoom = Math.max(0, Math.ceil(Math.log2(Math.max(width, height) / size)));
+
+        // Choose the zoom level at which one tile pixel is not smaller than
+        // one canvas pixel:
+        let scale = ctx.getTransform().a;
+        let level = Math.min(max_zoom, Math.max(0, Math.floor(Math.log2(1 / scale))));
+        let z = max_zoom - level;
+        let downsample = Math.pow(2, level);
+        let span = size * downsample;
+
+        this.applyFilters();
+
+        // The overview tile covers the whole image and fills the gaps until
+        // the other tiles have arrived:
+        let overview = this.loadTile(0, 0, 0);
+        if (overview.complete && overview.naturalWidth){
+            let factor = Math.pow(2, max_zoom);
+            ctx.drawImage(
+                overview, 0, 0, overview.width*factor, overview.height*factor
+            );
+        }
 
+        if (z != 0){
+            let top_left = ctx.getWorldCoords(0, 0);
+            let bottom_right = ctx.getWorldCoords(canvas.width, canvas.height);
+            let x_min = Math.max(0, Math.floor(top_left.x / span));
+            let y_min = Math.max(0, Math.floor(top_left.y / span));
+            let x_max = Math.min(Math.ceil(width / span), Math.ceil(bottom_right.x / span));
+            let y_max = Math.min(Math.ceil(height / span), Math.ceil(bottom_right.y / span));
+
+            for (let y = y_min; y < y_max; y++){
+                for (let x = x_min; x < x_max; x++){
+                    let tile = this.loadTile(z, x, y);
+                    if (!tile.complete || !tile.naturalWidth){
+                        continue;
+                    }
+                    ctx.drawImage(
+                        tile, x*span, y*span,
+                        tile.width*downsample, tile.height*downsample
+                    );
+                }
+            }
+        }
+
+        // Set mask visibility based on current vars.show_mask
+        show_mask(vars.show_mask);
+    }
+    applyFilters(){
+        let canvas = this.container;
         let filters = this.vm.filters;
         if (filters !== null){
             // Apply brightness, contrast and saturation filters:
@@ -415,13 +571,6 @@ class RGBLayer extends CanvasLayer{
             filter_string.push("saturate("+filters.saturation+"%)");
             canvas.style.filter = filter_string.join(" ");
         }
-
-        ctx.drawImage(
-            image, 0, 0, image.width, image.height
-        );
-
-        // Set mask visibility based on current vars.show_mask
-        show_mask(vars.show_mask);
     }
 }
 
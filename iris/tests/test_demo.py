@@ -1,3 +1,5 @@
+import json
+
 from flask import url_for
 import pytest
 import requests
@@ -15,13 +17,14 @@ class TestCore:
         addresses = [
             # admin
             'admin/users', 'admin/images', 'admin/actions/segmentation',
-            'admin/actions/detection',
+            'admin/actions/detection', 'admin/stats',
             # user
             'user/get/current', 'user/show/current', 'user/config',
             'user/save_config',
             # segmentation
             'segmentation/load_mask/1', 'segmentation/save_mask/1',
-            'segmentation/predict_mask/1'
+            'segmentation/predict_mask/1', 'segmentation/predict_mask/1/submit',
+            'segmentation/jobs/1', 'segmentation/jobs/1/result'
         ]
         for address in map(self.url, addresses):
             print("Check", address)
@@ -29,3 +32,569 @@ class TestCore:
             if response.status_code == 405:
                 response = requests.post(address, {})
             assert response.status_code == 403
+
+    def test_image_views(self):
+        from iris.project import project
+
+        image_id = project.image_ids[0]
+        for view in project['views']:
+            if project['views'][view]['type'] != 'image':
+                continue
+            for address in [f'image/{image_id}/{view}', f'tile/{image_id}/{view}/0/0/0']:
+                response = requests.get(self.url(address))
+                assert response.status_code == 200
+                assert response.headers['Content-Type'] == 'image/png'
+
+        response = requests.get(self.url(f'image/{image_id}/unknown_view'))
+        assert response.status_code == 404
+
+        view = next(
+            view for view in project['views']
+            if project['views'][view]['type'] == 'image'
+        )
+        response = requests.get(
+            self.url(f'image/{image_id}/{view}'), params={'format': 'jpeg'}
+        )
+        assert response.headers['Content-Type'] == 'image/jpeg'
+        response = requests.get(
+            self.url(f'image/{image_id}/{view}'),
+            headers={'Accept': 'image/webp,image/jpeg;q=0.5'}
+        )
+        assert response.headers['Content-Type'] == 'image/webp'
+        # Browsers accept everything, so the format of the project is used:
+        response = requests.get(
+            self.url(f'image/{image_id}/{view}'),
+            headers={
+                'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,'
+                    'image/*,*/*;q=0.8'
+            }
+        )
+        assert response.headers['Content-Type'] == 'image/png'
+        response = requests.get(
+            self.url(f'image/{image_id}/{view}'), params={'format': 'gif'}
+        )
+        assert response.status_code == 400
+
+        response = requests.get(self.url(f'image/{image_id}/{view}'))
+        response = requests.get(
+            self.url(f'image/{image_id}/{view}'),
+            headers={'If-None-Match': response.headers['ETag']}
+        )
+        assert response.status_code == 304
+
+        views = [
+            view for view in project['views']
+            if project['views'][view]['type'] == 'image'
+        ]
+        response = requests.get(
+            self.url(f'views/{image_id}'), params={'view': views}
+        )
+        assert response.status_code == 200
+        header_length = int.from_bytes(response.content[:4], 'little')
+        header = json.loads(response.content[4:4+header_length])
+        assert [file['name'] for file in header['files']] == views
+
+    def test_thumbnails(self):
+        from iris.project import project
+
+        image_id = project.image_ids[0]
+        response = requests.get(
+            self.url(f'thumbnail/{image_id}'), params={'size': '50x50'}
+        )
+        assert response.status_code == 200
+
+        response = requests.get(
+            self.url('contact_sheet'),
+            params={'image_id': project.image_ids[:2], 'size': '50x50'}
+        )
+        assert response.status_code == 200
+        header_length = int.from_bytes(response.content[:4], 'little')
+        header = json.loads(response.content[4:4+header_length])
+        assert list(header['thumbnails']) == project.image_ids[:2]
+
+    def test_metadata(self):
+        from iris.project import project
+
+        response = requests.get(
+            self.url('metadata'), params={'sort': '-location.0'}
+        )
+        assert response.status_code == 200
+        assert response.json()['total'] == len(project.image_ids)
+
+        response = requests.get(self.url('metadata'), params={'filter': '=='})
+        assert response.status_code == 400
+
+def get_test_user(app):
+    from iris.models import db, User
+
+    with app.app_context():
+        user = User.query.filter_by(name='test').first()
+        if user is None:
+            user = User(name='test')
+            db.session.add(user)
+            db.session.commit()
+        return user.id
+
+def test_prediction_job(app):
+    from os.path import join
+    import shutil
+    import time
+    import numpy as np
+    from iris.jobs import jobs
+    from iris.project import project
+
+    assert jobs.config['workers'] >= 1
+    user_id = get_test_user(app)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+    # The model uses bands of several files, which are read concurrently:
+    bands = ['$Sentinel1.B1', '$Sentinel2.B2']
+    project.save_user_config(
+        user_id, {'segmentation': {'ai_model': {'bands': bands}}}
+    )
+    image_id = project.image_ids[0]
+    shutil.rmtree(join(project['path'], 'features', 'v1', image_id), True)
+    # Read them in the server process before the workers are started, so that
+    # its I/O threads are already running:
+    project.get_image(image_id, bands=bands)
+
+    height, width = project['segmentation']['mask_shape']
+    pixels = np.random.RandomState(0).choice(height*width, 400, replace=False)
+    response = client.post(
+        f'/segmentation/predict_mask/{image_id}/submit',
+        data=json.dumps({
+            'user_pixels': pixels.tolist(),
+            'user_labels': (pixels % width > width // 2).astype(int).tolist()
+        })
+    )
+    assert response.status_code == 202
+    job = response.get_json()
+
+    deadline = time.time() + 120
+    while job['state'] in ['queued', 'running'] and time.time() < deadline:
+        time.sleep(0.2)
+        job = client.get(f'/segmentation/jobs/{job["id"]}').get_json()
+    assert job['state'] == 'done'
+
+    response = client.get(f'/segmentation/jobs/{job["id"]}/result')
+    assert len(response.data) == height * width
+
+def worker_state(threads=None):
+    import sys
+    import threading
+    from iris.project import project
+
+    return (
+        hasattr(sys.modules['iris'], 'app'), project.file,
+        [thread.name for thread in threading.enumerate()]
+    )
+
+def test_worker_process():
+    from iris.jobs import jobs
+    from iris.project import project
+
+    assert jobs.config['workers'] >= 1
+    job = jobs.submit('worker-state', None, worker_state)
+    has_app, project_file, threads = jobs.result(job, timeout=120)
+    # The worker loaded the project without creating the app or rescanning
+    # the manifest:
+    assert not has_app
+    assert project_file == project.file
+    assert 'manifest' not in threads
+
+def test_manifest(tmp_path):
+    import os
+    import numpy as np
+    from iris.manifest import Manifest
+
+    def describe(path):
+        shape = np.load(path).shape
+        return {'bands': 1, 'shape': [shape[1], shape[0]]}
+
+    for image_id in ['a', 'b']:
+        np.save(tmp_path / f'{image_id}.npy', np.zeros((2, 3)))
+    manifest = Manifest(
+        str(tmp_path / 'manifest.json'), str(tmp_path / '{id}.npy'), describe
+    )
+    assert manifest.scan()
+    assert manifest.image_ids == ['a', 'b']
+    assert manifest.get_file(str(tmp_path / 'a.npy'))['shape'] == [3, 2]
+
+    # Rewriting a file does not change the mtime of its directory:
+    stat = os.stat(tmp_path)
+    np.save(tmp_path / 'a.npy', np.zeros((4, 5)))
+    os.utime(tmp_path / 'a.npy', (stat.st_mtime + 10, stat.st_mtime + 10))
+    os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+    assert not manifest.scan()
+    assert manifest.get_file(str(tmp_path / 'a.npy'))['shape'] == [5, 4]
+
+    loaded = Manifest(
+        str(tmp_path / 'manifest.json'), str(tmp_path / '{id}.npy'), describe
+    )
+    assert loaded.load()
+    assert loaded.get_file(str(tmp_path / 'a.npy'))['shape'] == [5, 4]
+
+def test_add_images():
+    from iris.project import project
+
+    image_ids, image_order = project.image_ids, project.image_order
+    image_id_set = project.image_id_set
+    try:
+        project.set_image_seed(1)
+        order = [project.image_ids[index] for index in project.image_order]
+        assert not project.has_image('new')
+        project.add_images([*project.image_ids, 'new'])
+        assert project.has_image('new')
+        project.set_image_seed(1)
+        assert [
+            project.image_ids[index] for index in project.image_order
+        ] == [*order, 'new']
+    finally:
+        project.image_ids, project.image_order = image_ids, image_order
+        project.image_id_set = image_id_set
+
+@pytest.mark.parametrize('source', [
+    '$Sentinel2.B1.__class__',
+    '__import__("os")',
+    '$Sentinel2.__dict__',
+    'lambda: $Sentinel2.B1',
+    '[band for band in $Sentinel2.B1]',
+    '{band: 1 for band in $Sentinel2.B1}',
+    'open("iris.db")',
+    'eval("1")',
+    'edges.__globals__',
+    '$Sentinel2["__class__"]',
+    '$Sentinel2',
+    '$Unknown.B1',
+])
+def test_expression_whitelist(source):
+    from iris.expressions import ExpressionCompiler
+
+    compiler = ExpressionCompiler(['Sentinel1', 'Sentinel2'])
+    with pytest.raises(Exception, match=r'\[CONFIG\]'):
+        compiler.parse(source)
+
+def test_expressions_match_eval():
+    import re
+    import numpy as np
+    from iris.expressions import FUNCTIONS
+    from iris.project import project
+
+    image_id = project.image_ids[0]
+    image = project.get_image(image_id, downsample=4)
+    # The namespace of the former eval-based evaluation (with 'max' mapped
+    # to np.max instead of np.min):
+    environment = {
+        **FUNCTIONS, **{key.strip('$'): value for key, value in image.items()}
+    }
+    for view in project['views'].values():
+        if 'data' not in view:
+            continue
+        bands = project.evaluate_view(image_id, view, downsample=4)
+        for source, band in zip(view['data'], bands):
+            expression = re.sub(r'\$(\w+)\.(\w+)', r'\1["\2"]', source)
+            expression = re.sub(r'\$(\w+)', r'\1', expression)
+            expected = eval(expression, {"__builtins__": None}, environment)
+            np.testing.assert_array_equal(band, expected)
+
+def test_feature_store(tmp_path):
+    import time
+    import numpy as np
+    from iris.cache import FeatureStore
+
+    computed = []
+    def compute():
+        computed.append(True)
+        return np.arange(6, dtype=np.float32).reshape(3, 2)
+
+    store = FeatureStore(2**20, directory=str(tmp_path))
+    features = store.get('image', ('$B1',), 0, compute)
+    assert not features.flags.writeable
+    assert store.get('image', ('$B1',), 0, compute) is features
+    assert len(computed) == 1
+
+    # Memory-mapped from disk after a restart:
+    store = FeatureStore(2**20, directory=str(tmp_path))
+    np.testing.assert_array_equal(
+        store.get('image', ('$B1',), 0, compute), features
+    )
+    assert len(computed) == 1 and store.disk_hits == 1
+
+    # Other options or modified images are computed again:
+    store.get('image', ('$B2',), 0, compute)
+    store.get('image', ('$B1',), time.time() + 60, compute)
+    assert len(computed) == 3
+
+def test_features_match_computed():
+    from copy import deepcopy
+    import numpy as np
+    from iris.project import project
+    from iris.ai import compute_features, get_features
+
+    config = deepcopy(project['segmentation'])
+    config['ai_model']['use_edge_filter'] = True
+    image_id = project.image_ids[0]
+    np.testing.assert_array_equal(
+        get_features(image_id, config), compute_features(image_id, config)
+    )
+
+def test_warm_start():
+    from copy import deepcopy
+    import numpy as np
+    from iris.project import project
+    from iris.ai import continue_training, get_features, train_model
+
+    config = deepcopy(project['segmentation'])
+    ai_config = config['ai_model']
+    image_id = project.image_ids[0]
+    inputs = get_features(image_id, config)
+    height, width = config['mask_shape']
+    indices = np.random.RandomState(0).choice(height*width, 600, replace=False)
+    labels = (indices % width > width // 2).astype(int)
+
+    session = train_model(
+        image_id, 'warm-start', config, inputs, indices[:400], labels[:400]
+    )
+    iterations = session.booster.current_iteration()
+
+    # Further pixels of the same classes continue boosting:
+    warm = train_model(
+        image_id, 'warm-start', config, inputs, indices, labels
+    )
+    assert warm is session
+    assert warm.booster.current_iteration() \
+        == iterations + ai_config['warm_start_rounds']
+    assert len(warm.indices) == 600
+
+    # Relabelled pixels require a new model:
+    relabelled = labels.copy()
+    relabelled[0] = 1 - relabelled[0]
+    cold = train_model(
+        image_id, 'warm-start', config, inputs, indices, relabelled
+    )
+    assert cold is not session
+
+    # New pixels of only one class (LightGBM may find no further split):
+    iterations = cold.booster.current_iteration()
+    new = np.setdiff1d(np.arange(height*width), indices)[:50]
+    continue_training(cold, config, inputs, new, np.ones(50, dtype=int))
+    assert cold.booster.current_iteration() >= iterations
+    assert cold.predict(inputs).shape == (height*width,)
+
+def sleep_job(seconds, threads=None):
+    import time
+
+    time.sleep(seconds)
+    return seconds, threads
+
+def test_job_replace_and_cancel():
+    from concurrent.futures import CancelledError
+    import time
+    from iris.jobs import JobQueue
+
+    jobs = JobQueue()
+    jobs.init({
+        'workers': 0, 'result_ttl': 300, 'threads': 2, 'threads_per_job': None
+    })
+    running = jobs.submit('a', 1, sleep_job, 0.5)
+    while running.state == 'queued':
+        time.sleep(0.01)
+    assert running.state == 'running'
+
+    # Queued jobs of the same user are replaced:
+    replaced = jobs.submit('a', 2, sleep_job, 0)
+    latest = jobs.submit('a', 3, sleep_job, 0)
+    assert replaced.state == 'replaced'
+    with pytest.raises(CancelledError):
+        jobs.result(replaced, timeout=5)
+
+    jobs.cancel(latest)
+    assert latest.state == 'cancelled'
+    with pytest.raises(CancelledError):
+        jobs.result(latest, timeout=5)
+
+    assert jobs.result(running, timeout=5) == (0.5, 2)
+    info = running.to_json()
+    assert info['state'] == 'done'
+    assert info['threads'] == 2
+    assert info['wall_time'] >= 0.5
+    stats = jobs.stats()
+    assert (stats['submitted'], stats['replaced'], stats['cancelled']) \
+        == (3, 1, 1)
+
+def test_concurrent_jobs():
+    import json
+    from os.path import dirname, join
+    import time
+    from iris.jobs import JobQueue
+
+    # The default config of the jobs:
+    with open(join(dirname(__file__), '..', 'default_config.json')) as stream:
+        config = json.load(stream)['jobs']
+    jobs = JobQueue()
+    jobs.init(config)
+    assert config['workers'] == 2
+    total = jobs.budget.total
+
+    # Users which are served by different workers:
+    users = {}
+    for user_id in map(str, range(100)):
+        users.setdefault(jobs._get_slot(user_id), user_id)
+    submitted = [
+        jobs.submit(user_id, None, sleep_job, 1) for user_id in users.values()
+    ]
+    deadline = time.time() + 120
+    while any(job.state != 'running' for job in submitted) \
+            and time.time() < deadline:
+        time.sleep(0.05)
+    assert [job.state for job in submitted] == ['running', 'running']
+    assert [job.threads for job in submitted] == [total // 2, total // 2]
+
+    for job in submitted:
+        assert jobs.result(job, timeout=120) == (1, total // 2)
+
+def test_thread_budget():
+    import threading
+    import time
+    from iris.jobs import ThreadBudget
+
+    budget = ThreadBudget(4, 2)
+    first = budget.acquire()
+    second = budget.acquire()
+    assert (first, second) == (2, 2)
+
+    admitted = []
+    def acquire(name):
+        admitted.append((name, budget.acquire()))
+
+    waiters = []
+    for name in ['third', 'fourth']:
+        waiters.append(threading.Thread(target=acquire, args=(name,)))
+        waiters[-1].start()
+        # Let each waiter queue up before the next one:
+        while budget.stats()['waiting'] < len(waiters):
+            time.sleep(0.01)
+    assert budget.stats() == {
+        'total': 4, 'per_job': 2, 'in_use': 4, 'waiting': 2
+    }
+
+    # The waiters are admitted in order and share the freed threads:
+    budget.release(first)
+    for waiter in waiters:
+        waiter.join(timeout=5)
+    assert admitted == [('third', 1), ('fourth', 1)]
+    assert budget.stats()['in_use'] == 4
+    assert budget.stats()['waiting'] == 0
+
+    for threads in [second, 1, 1]:
+        budget.release(threads)
+    assert budget.stats()['in_use'] == 0
+
+def test_sample_pixels():
+    import numpy as np
+    from iris.ai import sample_pixels
+
+    labels = np.repeat([0, 1, 2], [10000, 500, 50])
+    weights = np.ones(len(labels))
+    rng = np.random.RandomState(0)
+
+    # Each class is sampled on its own and large ones are capped:
+    train, val = sample_pixels(labels, weights, 0.8, 1000, rng)
+    assert np.bincount(labels[train]).tolist() == [1000, 400, 40]
+    assert np.bincount(labels[val]).tolist() == [250, 100, 10]
+    assert not np.intersect1d(train, val).size
+
+    train, val = sample_pixels(labels, weights, 1, 1000, rng)
+    assert np.bincount(labels[train]).tolist() == [1000, 500, 50]
+    assert not val.size
+
+    # A ratio of 0 still trains on one pixel per class:
+    train, val = sample_pixels(labels, weights, 0, 1000, rng)
+    assert np.bincount(labels[train]).tolist() == [1, 1, 1]
+    assert len(train) + len(val) == len(labels)
+
+    # Boundary pixels are preferred:
+    weights = np.where(np.arange(len(labels)) < 100, 1e6, 1.)
+    train, _ = sample_pixels(labels, weights, 0.8, 100, rng)
+    assert sorted(train[labels[train] == 0]) == list(range(100))
+
+def test_pixel_weights():
+    import numpy as np
+    from iris.ai import get_pixel_weights
+
+    # Two strokes in a 3x4 mask which touch each other in the middle:
+    indices = np.array([0, 1, 2, 5, 6, 7])
+    labels = np.array([0, 0, 1, 0, 1, 1])
+    weights = get_pixel_weights(indices, labels, (3, 4), 5)
+    assert weights.tolist() == [1, 5, 5, 5, 5, 1]
+    assert get_pixel_weights(indices, labels, (3, 4), 1).tolist() == [1]*6
+
+def test_train_ratio_config(tmp_path):
+    import json
+    import os
+    from iris.project import Project
+
+    demo = os.path.join(os.path.dirname(__file__), '..', '..', 'demo')
+    with open(os.path.join(demo, 'cloud-segmentation.json')) as stream:
+        config = json.load(stream)
+    for name, path in config['images']['path'].items():
+        config['images']['path'][name] = os.path.abspath(
+            os.path.join(demo, path)
+        )
+    config['segmentation']['ai_model'] = {'train_ratio': 0}
+    with open(tmp_path / 'project.json', 'w') as stream:
+        json.dump(config, stream)
+
+    with pytest.raises(Exception, match='train_ratio'):
+        Project().load_from(str(tmp_path / 'project.json'))
+
+def test_missing_metadata(app, tmp_path):
+    from iris.cache import MetadataIndex
+    from iris.project import project
+
+    *image_ids, missing = project.image_ids
+    for image_id in image_ids:
+        with open(tmp_path / f'{image_id}.json', 'w') as stream:
+            json.dump({'name': image_id}, stream)
+
+    metadata, index = project['images']['metadata'], project.metadata_index
+    try:
+        project['images']['metadata'] = str(tmp_path / '{id}.json')
+        project.metadata_index = MetadataIndex(str(tmp_path / 'index.json'))
+        response = app.test_client().get('/metadata')
+    finally:
+        project['images']['metadata'], project.metadata_index = metadata, index
+
+    assert response.status_code == 200
+    images = {
+        image['id']: image['metadata']
+        for image in response.get_json()['images']
+    }
+    assert images[missing] == {}
+    assert images[image_ids[0]] == {'name': image_ids[0]}
+
+def test_metadata_index(tmp_path):
+    from datetime import date, datetime
+    from iris.cache import MetadataIndex
+
+    def parse(filename):
+        return {
+            'date': date(2020, 1, 31), 'time': datetime(2020, 1, 31, 12, 30),
+            'bands': (1, 2), 1: 'key',
+        }
+
+    index = MetadataIndex(str(tmp_path / 'metadata_index.json'))
+    fresh = index.get('a', 'a.yaml', 1., parse)
+    assert fresh == {
+        'date': '2020-01-31', 'time': '2020-01-31T12:30:00',
+        'bands': [1, 2], '1': 'key',
+    }
+    assert index.get('a', 'a.yaml', 1., parse) is fresh
+    index.save()
+
+    # The reloaded index returns the same metadata without parsing:
+    reloaded = MetadataIndex(str(tmp_path / 'metadata_index.json'))
+    assert reloaded.get('a', 'a.yaml', 1., None) == fresh
+    assert reloaded.stats()['hits'] == 1
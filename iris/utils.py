@@ -1,7 +1,17 @@
 from copy import deepcopy
+import sys
 
 import flask
 import markupsafe
+import numpy as np
+from PIL import Image as PILImage
+from skimage.transform import resize
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
 
 
 class View:
@@ -24,3 +34,46 @@ def merge_deep_dicts(d1, d2):
         else:
             merged[k] = merge_deep_dicts(merged[k], v)
     return merged
+
+def get_peak_rss():
+    """Get the peak resident set size of this process in bytes
+
+    Returns:
+        The peak RSS or None if it cannot be determined (e.g. on Windows).
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes:
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def resize_image(array, shape=None, fit=None):
+    """Resize an image array
+
+    Args:
+        array: Image as HxW or HxWxC array.
+        shape: Exact output shape as (height, width).
+        fit: Maximal length of the larger side, the aspect ratio is kept.
+            Images which are small enough already are not changed.
+
+    Returns:
+        The resized image. uint8 images are resized with Pillow (fast and
+        still uint8), all other images with skimage (floats between 0 and 1).
+    """
+    height, width = array.shape[:2]
+    if fit is not None:
+        scale = fit / max(height, width)
+        if scale >= 1:
+            return array
+        shape = (max(1, round(height*scale)), max(1, round(width*scale)))
+    if tuple(shape) == (height, width):
+        return array
+
+    if array.dtype == np.uint8:
+        image = PILImage.fromarray(array).resize(
+            (shape[1], shape[0]), PILImage.BILINEAR
+        )
+        return np.asarray(image)
+
+    return resize(array, shape)
@@ -0,0 +1,30 @@
+"""Entry points of the worker processes which run the jobs (see `iris.jobs`)
+
+The workers are spawned, i.e. they import the package anew. In a worker
+process, importing iris does not create the app (see `iris/__init__.py`), so
+the workers only load the project, without the background rescans of the
+manifest and without prefetching or job queues of their own.
+
+"""
+import time
+
+from iris.project import project
+
+
+def init_worker(project_file):
+    """Load the project in a spawned worker process"""
+    if project.file is None:
+        project.load_from(project_file, rescan=False)
+
+
+def run_job(function, args, threads):
+    """Run the function of a job and measure its wall and CPU time"""
+    # The CPU time includes all threads of the worker process (with workers=0,
+    # of the whole server process):
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = function(*args, threads=threads)
+    return (
+        result, time.perf_counter() - wall_start,
+        time.process_time() - cpu_start
+    )